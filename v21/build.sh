@@ -54,6 +54,21 @@ fi
 echo "📦 Building Host/Device Agents..."
 pyinstaller -F --clean --name dmx_host_agent dmxperf/agents/host_agent.py
 pyinstaller -F --clean --name dmx_device_agent dmxperf/agents/device_agent.py
+pyinstaller -F --clean --name dmx_agent dmxperf/agents/unified_agent.py
+
+# 2.1 统一 Agent 的 zipapp 形态: 仅标准库，由节点自带 python3 直接运行，免去 onefile 每次解压到 /tmp
+#     同时放入 unchecked-hash 的 .pyc: 与节点 Python 版本一致时免编译，不一致时 zipimport 自动回退到 .py
+echo "📦 Building stdlib-only agent bundle (dmx_agent.pyz)..."
+AGENT_STAGE=build/agent_pyz
+mkdir -p "$AGENT_STAGE"
+cp dmxperf/agents/agent_common.py dmxperf/agents/host_agent.py \
+   dmxperf/agents/device_agent.py dmxperf/agents/unified_agent.py "$AGENT_STAGE"/
+python3 -m compileall -q -b --invalidation-mode unchecked-hash "$AGENT_STAGE"
+python3 -m zipapp "$AGENT_STAGE" -m "unified_agent:main" -p "/usr/bin/env python3" -o dist/dmx_agent.pyz
+if [ $? -ne 0 ]; then
+    echo "❌ zipapp Build Failed!"
+    exit 1
+fi
 
 # === 3. 打包 主控程序 ===
 echo "📦 Building Main Controller (Flat CLI)..."
@@ -79,6 +94,10 @@ mkdir -p release/configs
 mv dist/dmxperf release/bin/
 mv dist/dmx_host_agent release/bin/
 mv dist/dmx_device_agent release/bin/
+mv dist/dmx_agent release/bin/
+mv dist/dmx_agent.pyz release/bin/
+# 树状扇出中继: 仅标准库的单文件脚本，由中继节点 python3 从共享目录直接运行
+cp dmxperf/infra/relay.py release/bin/dmx_relay.py
 
 if [ -d "configs" ]; then
     cp -r configs/* release/configs/ 2>/dev/null
@@ -91,4 +110,6 @@ echo "👉 Examples:"
 echo "   ./release/bin/dmxperf --help         (查看详细帮助)"
 echo "   ./release/bin/dmxperf --topo         (拓扑+硬件信息)"
 echo "   ./release/bin/dmxperf --burn 60      (烤机)"
-echo "   ./release/bin/dmxperf -c task.json   (监控)"
\ No newline at end of file
+echo "   ./release/bin/dmxperf -c task.json   (监控)"
+echo "   python3 -m dmxperf.tools.agent_startup_bench --onefile release/bin/dmx_agent --pyz release/bin/dmx_agent.pyz"
+echo "                                        (Agent 启动延迟对比)"
\ No newline at end of file
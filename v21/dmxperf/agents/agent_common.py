@@ -0,0 +1,563 @@
+# dmxperf/agents/agent_common.py
+# -*- coding: utf-8 -*-
+# Host/Device Agent 共用组件 (仅依赖标准库，可随 Agent 脚本单独分发)
+import os
+import socket
+import time
+import threading
+import queue
+
+# ==============================================================================
+# AsyncWriter - 按文件攒批写入，按时间/大小刷盘
+# ==============================================================================
+class AsyncWriter:
+    """
+    后台线程写 CSV。每个文件的行先缓存在内存，满足任一条件时一次性写出:
+      - 缓存字节数 >= flush_bytes
+      - 最早一行已缓存 >= flush_interval 秒
+    flush_interval <= 0 时退化为逐行写出 (旧行为)。
+    close() 保证最终刷盘 + fsync，并打印写出字节数/刷盘次数。
+
+    layout:
+      - "wide": 每个 PID 一个目录，每个指标文件一个 CSV (旧布局)
+      - "long": 进程级数据追加到节点目录下的单个 <role>_samples.csv 文件，
+                列为 Timestamp,PID,Metric,Value；节点级文件 (pid 为空) 不受影响
+
+    队列有界 (max_queue 条)，写盘卡住 (如 NFS 停顿) 时按 policy 处理:
+      - "block":       阻塞采样线程直到队列有空位
+      - "drop_oldest": 丢弃队列中最旧的样本
+      - "spill":       溢出到节点本地文件 (spill_dir)，队列回落到低水位 (max_queue/4) 或空闲时/退出前回放
+    spill 下按目标文件保序: 某文件一旦溢出，其后续行也直接进溢出文件直到回放完成；
+    回放前须等溢出发生前已入队的行全部写出 (入队/写出序号计数作屏障)，避免旧行排在回放行之后。
+    丢弃/溢出的行数由 dropped/spilled 计数，退出时写入 writer_loss_<role>.csv。
+
+    mark(state) 在状态目录 (state_dir/<node>，未指定时为节点数据目录) 写状态标记 .agent_<role>_<pid>.<state>，
+    内容为 "pid,starttime,pgid,时间戳"，Controller 据此等待与停止而不是固定 sleep / pkill -f:
+      - pid:   进程已启动 (由入口在任何初始化之前调用 register_agent 写出，登记 PID 与启动时间，
+               停止时只向登记且启动时间一致的进程发信号)
+      - ready: 首个 tick 已完成采样
+      - done:  close() 已刷盘 + fsync，进程即将退出
+    pgid 仅在 Agent 独占会话 (由 setsid 启动) 时非 0，此时可按进程组发信号 (覆盖 onefile 引导进程)。
+    """
+    MARK_PREFIX = ".agent_"
+    LONG_HEADER = "Timestamp,PID,Metric,Value"
+    POLICIES = ("block", "drop_oldest", "spill")
+
+    def __init__(self, root, node, flush_interval=5.0, flush_bytes=65536, layout="wide", role="agent",
+                 max_queue=50000, policy="spill", spill_dir="/tmp", state_dir=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"未知队列策略: {policy}")
+        self.q = queue.Queue(maxsize=max(1, max_queue))
+        self.node_dir = os.path.join(root, node)
+        self.node_name = node
+        self.role = role
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.layout = layout
+        self.long_path = os.path.join(self.node_dir, f"{role}_samples.csv")
+        self.state_dir = os.path.join(state_dir, node) if state_dir else self.node_dir
+        self.policy = policy
+        self.dropped = 0
+        self.spilled = 0
+        self.spill_path = os.path.join(spill_dir, f"dmxperf_spill_{node}_{role}_{os.getpid()}.tsv")
+        self.spill_f = None
+        self.spill_lock = threading.Lock()
+        self.spill_paths = set()   # 溢出文件中有行、尚未回放的目标文件
+        self.low_water = max(1, self.q.maxsize // 4)
+        self.put_seq = 0           # 已入队条数 (spill 策略下计数)
+        self.done_seq = 0          # 写线程已处理条数
+        self.replay_after = 0      # 回放屏障: 最近一个文件开始溢出时的 put_seq
+        self.metric_names = {}  # (filename, header) -> [metric, ...]
+        self.files = {}
+        self.buffers = {}   # path -> [lines, nbytes, first_time]
+        self.bytes_written = 0
+        self.flush_count = 0
+        try:
+            os.makedirs(self.node_dir, exist_ok=True)
+            print(f"[AsyncWriter] 数据输出目录: {self.node_dir}")
+        except Exception as e:
+            print(f"❌ 目录创建失败: {e}")
+            raise e
+        self.t = threading.Thread(target=self._loop, daemon=True)
+        self.t.start()
+
+    def _metrics_of(self, filename, header):
+        """long 布局下的指标名: 与 DataCollector 对宽表列的重命名规则一致 (文件名_列名)"""
+        key = (filename, header)
+        names = self.metric_names.get(key)
+        if names is None:
+            stem = os.path.splitext(filename)[0]
+            cols = [c.strip() for c in (header or "Timestamp,Value").split(',')[1:]]
+            names = [stem if c.lower() == "value" else f"{stem}_{c}" for c in cols]
+            self.metric_names[key] = names
+        return names
+
+    def write(self, pid, filename, ts, val, header=None):
+        if self.layout == "long" and pid != "" and pid is not None:
+            names = self._metrics_of(filename, header)
+            vals = str(val).split(',') if len(names) > 1 else [val]
+            lines = "".join(f"{ts},{pid},{m},{v}\n" for m, v in zip(names, vals))
+            self._put((self.long_path, lines, self.LONG_HEADER))
+            return
+        if pid == "" or pid is None:
+            path = os.path.join(self.node_dir, filename)
+        else:
+            path = os.path.join(self.node_dir, f"{self.node_name}-PID{pid}", filename)
+        self._put((path, f"{ts},{val}\n", header))
+
+    def _put(self, item):
+        if self.policy == "block":
+            self.q.put(item)
+            return
+
+        if self.policy == "drop_oldest":
+            try:
+                self.q.put_nowait(item)
+                return
+            except queue.Full: pass
+            while True:
+                try:
+                    old = self.q.get_nowait()
+                    if old is not None: self.dropped += old[1].count('\n')
+                except queue.Empty: pass
+                try:
+                    self.q.put_nowait(item)
+                    return
+                except queue.Full: continue
+
+        with self.spill_lock:
+            if item[0] not in self.spill_paths:
+                try:
+                    self.q.put_nowait(item)
+                    self.put_seq += 1
+                    return
+                except queue.Full: pass
+                self.spill_paths.add(item[0])
+                self.replay_after = self.put_seq
+            self._spill(item)
+
+    def _spill(self, item):
+        """追加到溢出文件 (调用方持有 spill_lock)"""
+        path, lines, header = item
+        rows = lines.splitlines(True)
+        try:
+            if self.spill_f is None:
+                self.spill_f = open(self.spill_path, 'a', encoding='utf-8')
+            # 每行一条: 目标文件 \t 表头 \t 数据行
+            self.spill_f.write("".join(f"{path}\t{header or ''}\t{r}" for r in rows))
+            self.spilled += len(rows)
+        except:
+            self.dropped += len(rows)
+
+    def _can_replay(self):
+        """队列已回落到低水位，且溢出前入队的行都已写出"""
+        return (self.spill_f is not None and self.done_seq >= self.replay_after
+                and self.q.qsize() <= self.low_water)
+
+    def _replay_spill(self):
+        """把溢出文件中的行按原目标文件写回 (写线程内调用)"""
+        with self.spill_lock:
+            if self.spill_f is None: return
+            try: self.spill_f.close()
+            except: pass
+            self.spill_f = None
+            replay_path = self.spill_path + ".replay"
+            try: os.replace(self.spill_path, replay_path)
+            except: return
+            # 之后入队的行排在回放之后由本线程写出，顺序不变
+            self.spill_paths.clear()
+        try:
+            with open(replay_path, 'r', encoding='utf-8') as f:
+                for rec in f:
+                    path, header, row = rec.split('\t', 2)
+                    if path not in self.files:
+                        self._open(path, header or None)
+                    self._append(path, row)
+            os.remove(replay_path)
+        except Exception as e:
+            print(f"⚠️ [AsyncWriter] 回放溢出文件失败 {replay_path}: {e}")
+
+    def _open(self, path, header_def):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(path, 'a', encoding='utf-8')
+        self.files[path] = f
+        if f.tell() == 0:
+            hdr = header_def if header_def else "Timestamp,Value"
+            if not hdr.endswith('\n'): hdr += '\n'
+            self._append(path, hdr)
+
+    def _append(self, path, line):
+        buf = self.buffers.get(path)
+        if buf is None:
+            buf = self.buffers[path] = [[], 0, time.monotonic()]
+        buf[0].append(line)
+        buf[1] += len(line)
+        if self.flush_interval <= 0 or buf[1] >= self.flush_bytes:
+            self._flush(path)
+
+    def _flush(self, path):
+        buf = self.buffers.pop(path, None)
+        if not buf: return
+        data = "".join(buf[0])
+        try:
+            f = self.files[path]
+            f.write(data)
+            f.flush()
+            self.bytes_written += len(data)
+            self.flush_count += 1
+        except: pass
+
+    def _flush_aged(self):
+        now = time.monotonic()
+        for path in [p for p, b in self.buffers.items() if now - b[2] >= self.flush_interval]:
+            self._flush(path)
+
+    def _loop(self):
+        # 有攒批时用超时 get，保证空闲期间缓存也能按时落盘
+        poll = min(1.0, self.flush_interval) if self.flush_interval > 0 else None
+        while True:
+            try:
+                item = self.q.get(timeout=poll)
+            except queue.Empty:
+                # 队列空闲: 先回放溢出数据，再按时落盘
+                if self._can_replay(): self._replay_spill()
+                self._flush_aged()
+                continue
+            if item is None: break
+            path, line, header_def = item
+            try:
+                if path not in self.files:
+                    self._open(path, header_def)
+                self._append(path, line)
+            except Exception as e: pass
+            self.done_seq += 1
+            if self._can_replay(): self._replay_spill()
+            if self.buffers: self._flush_aged()
+
+    def close(self):
+        # 1. 停止处理 (结束标记必须入队，不受丢弃策略影响)
+        self.q.put(None)
+        self.t.join()
+        self._replay_spill()
+
+        # 2. 写出剩余缓存并强制刷盘，确保数据写入 NFS
+        for path in list(self.buffers):
+            self._flush(path)
+        print(f"💾 [AsyncWriter] 正在强制同步 {len(self.files)} 个文件到磁盘...")
+        for f in self.files.values():
+            try:
+                f.flush()
+                os.fsync(f.fileno())
+            except: pass
+            try: f.close()
+            except: pass
+        print(f"💾 [AsyncWriter] 共写出 {self.bytes_written} 字节, 刷盘 {self.flush_count} 次, "
+              f"丢弃 {self.dropped} 行, 溢出 {self.spilled} 行")
+        self._write_loss()
+
+    def mark(self, state):
+        write_mark(self.state_dir, self.role, state)
+
+    def _write_loss(self):
+        """记录丢弃/溢出行数，供分析阶段识别数据缺口"""
+        try:
+            with open(os.path.join(self.node_dir, f"writer_loss_{self.role}.csv"), 'w', encoding='utf-8') as f:
+                f.write("Policy,MaxQueue,Dropped,Spilled\n")
+                f.write(f"{self.policy},{self.q.maxsize},{self.dropped},{self.spilled}\n")
+        except: pass
+
+def write_mark(state_dir, role, state):
+    """写状态标记 .agent_<role>_<pid>.<state> (先写临时文件再 rename，Controller 不会读到半个文件)"""
+    pid = os.getpid()
+    path = os.path.join(state_dir, f"{AsyncWriter.MARK_PREFIX}{role}_{pid}.{state}")
+    tmp = path + ".tmp"
+    try:
+        pgid = os.getpgid(0)
+        if os.getsid(0) != pgid: pgid = 0
+        os.makedirs(state_dir, exist_ok=True)
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(f"{pid},{PidMatcher.start_time(pid)},{pgid},{now_ns()}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"⚠️ [AsyncWriter] 状态标记写入失败 {path}: {e}")
+
+def register_agent(timeseries_root, state_dir, role):
+    """
+    登记 pid 标记。入口在解析完参数后立即调用，早于 AsyncWriter / NVML / 插件初始化:
+    初始化卡住 (NFS 停顿、nvmlInit 挂起) 的 Agent 也已登记，stop() 仍能按 PID 找到并终止它。
+    目录与 AsyncWriter.state_dir 一致。
+    """
+    node = socket.gethostname()
+    write_mark(os.path.join(state_dir or timeseries_root, node), role, "pid")
+
+# ==============================================================================
+# DeadlineScheduler - 基于 time.monotonic() 的固定周期调度
+# ==============================================================================
+class DeadlineScheduler:
+    """
+    第 k 个 tick 的截止时间为 t0 + k * interval，采样耗时不会累积成周期漂移。
+    若一次采样拖过了一个或多个截止时间，直接跳到最近的截止时间并把跳过的 tick 计入 missed。
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_t = time.monotonic()
+        self.ticks = 0
+        self.missed = 0
+
+    def wait(self):
+        self.next_t += self.interval
+        now = time.monotonic()
+        if now >= self.next_t:
+            late = int((now - self.next_t) / self.interval)
+            if late:
+                self.missed += late
+                self.next_t += late * self.interval
+        else:
+            time.sleep(self.next_t - now)
+        self.ticks += 1
+
+def now_ns():
+    """样本时间戳: epoch 纳秒整数 (避免秒级字符串在亚秒采样时重复)"""
+    return time.time_ns()
+
+# ==============================================================================
+# AgentStats - Agent 自身开销统计
+# ==============================================================================
+class AgentStats:
+    """
+    每个 tick 记录: 进程 CPU 时间 (含写线程)、tick 内总耗时、各采集阶段耗时、写队列深度、
+    累计错过的 tick 以及写队列累计丢弃/溢出行数。
+    用法: start() -> lap("stage") ... -> finish(writer, ts, missed)；退出时 summary() 输出一行汇总。
+    """
+    def __init__(self, stages, filename="agent_stats.csv"):
+        self.stages = list(stages)
+        self.filename = filename
+        self.header = ("Timestamp,CpuTime_ms,Tick_ms," + ",".join(f"{s}_ms" for s in self.stages)
+                       + ",QueueDepth,MissedTicks,Dropped,Spilled")
+        self.lat = dict.fromkeys(self.stages, 0.0)
+        self.lat_total = dict.fromkeys(self.stages, 0.0)
+        self.ticks = 0
+        self.max_depth = 0
+        self.wall0 = time.monotonic()
+        self.cpu0 = self.cpu_last = time.process_time()
+        self.tick_t0 = self.last = time.perf_counter()
+
+    def start(self):
+        self.tick_t0 = self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.lat[stage] += now - self.last
+        self.last = now
+
+    def finish(self, writer, ts, missed):
+        tick_s = time.perf_counter() - self.tick_t0
+        cpu = time.process_time()
+        cpu_s, self.cpu_last = cpu - self.cpu_last, cpu
+        depth = writer.q.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        self.ticks += 1
+        vals = [f"{cpu_s * 1000:.3f}", f"{tick_s * 1000:.3f}"]
+        for s in self.stages:
+            vals.append(f"{self.lat[s] * 1000:.3f}")
+            self.lat_total[s] += self.lat[s]
+            self.lat[s] = 0.0
+        vals += [str(depth), str(missed), str(writer.dropped), str(writer.spilled)]
+        writer.write("", self.filename, ts, ",".join(vals), header=self.header)
+
+    def summary(self, missed):
+        wall = max(1e-9, time.monotonic() - self.wall0)
+        cpu = time.process_time() - self.cpu0
+        n = max(1, self.ticks)
+        stages = ", ".join(f"{s}={self.lat_total[s] / n * 1000:.2f}ms" for s in self.stages)
+        return (f"CPU {cpu:.2f}s / Wall {wall:.1f}s = {cpu / wall * 100:.3f}% 单核, "
+                f"ticks={self.ticks}, missed={missed}, max_queue={self.max_depth}, 平均阶段耗时: {stages}")
+
+# ==============================================================================
+# 目标 PID 判定 (Host/Device 共用)
+# ==============================================================================
+class PidMatcher:
+    """
+    判定 PID 是否属于目标作业，结果按 (pid, 启动时间) 缓存:
+    启动时间取 /proc/<pid>/stat 第 22 列 (starttime)，PID 被复用时启动时间必然不同，缓存自动失效，
+    命中缓存只需读一次 stat，不再读取并解码 cmdline。
+
+    否定结论默认不缓存: fork 之后、exec 之前 cmdline 仍是启动器，exec 不改变启动时间；
+    调用方确认进程已完成 exec (如已出现在 NVML 计算进程列表中) 时可传 cache_negative=True。
+    缓存条目由调用方在进程离开其视野时 forget()。
+    """
+    # 黑名单: 排除启动器、Shell、以及 Agent 自身
+    BLACKLIST = {
+        "mpirun", "mpiexec", "orterun", "hydra_pmi_proxy", "srun",
+        "bash", "sh", "zsh", "csh", "tcsh",
+        "ssh", "sshd", "sudo", "su",
+        "dmxperf", "dmx_host_agent", "dmx_device_agent", "dmx_agent"
+    }
+    SELF_NAMES = ("dmxperf", "dmx_host_agent", "dmx_device_agent", "dmx_agent", "device_agent")
+
+    def __init__(self, target_name):
+        self.target_name = target_name
+        self.target_token = f"/{target_name}/"
+        self.my_pid = os.getpid()
+        self.cache = {}   # pid -> (starttime, verdict)
+
+    @staticmethod
+    def start_time(pid):
+        try:
+            with open(f"/proc/{pid}/stat", 'rb') as f:
+                # comm 可能含空格/括号，从最后一个 ')' 之后数: 第 3 列起，starttime 为第 22 列
+                return int(f.read().rsplit(b')', 1)[1].split()[19])
+        except: return None
+
+    def _check_cmdline(self, pid):
+        try:
+            with open(f"/proc/{pid}/cmdline", 'rb') as f:
+                content = f.read()
+        except: return False
+        if not content: return False
+        args = content.split(b'\0')
+        exe_path = args[0].decode(errors='ignore')
+        exe_name = os.path.basename(exe_path)
+        full_cmd = b" ".join(args).decode(errors='ignore')
+
+        # 1. 黑名单过滤
+        if exe_name in self.BLACKLIST: return False
+        # 2. 额外防护: 命令行包含自身名字的也不要
+        if any(n in full_cmd for n in self.SELF_NAMES): return False
+        # 3. 目标匹配逻辑
+        if self.target_token in exe_path: return True
+        if exe_path.startswith(f"./{self.target_name}"): return True
+        if ("python" in exe_name or "python3" in exe_name) and self.target_token in full_cmd: return True
+        return False
+
+    def match(self, pid, cache_negative=False):
+        if pid == self.my_pid: return False
+        st = self.start_time(pid)
+        if st is None:
+            self.cache.pop(pid, None)
+            return False
+        hit = self.cache.get(pid)
+        if hit is not None and hit[0] == st:
+            return hit[1]
+        verdict = self._check_cmdline(pid)
+        if verdict or cache_negative:
+            self.cache[pid] = (st, verdict)
+        else:
+            self.cache.pop(pid, None)
+        return verdict
+
+    def forget(self, pids):
+        for pid in pids:
+            self.cache.pop(pid, None)
+
+# ==============================================================================
+# Collector 插件 + 共享采样循环
+# ==============================================================================
+class Collector:
+    """
+    采集插件接口:
+      - stages:     在 AgentStats 中登记的阶段名；collect() 内可用 ctx.lap() 结束中间阶段，
+                    最后一个阶段由循环在 collect() 返回后结束
+      - needs_pids: 是否读取 ctx.pids (目标 PID 每 tick 只发现一次，所有插件共享)
+    """
+    name = "collector"
+    stages = ()
+    needs_pids = False
+
+    def collect(self, ctx):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class TickContext:
+    """单个 tick 内插件共享的状态: 时间戳、写入器、阶段计时，以及首次访问时才发现的目标 PID"""
+    def __init__(self, writer, stats, tracker=None):
+        self.writer = writer
+        self.stats = stats
+        self.tracker = tracker
+        self.ts = None
+        self._pids = None
+        self._pid_set = None
+
+    def begin(self, ts):
+        self.ts = ts
+        self._pids = None
+        self._pid_set = None
+
+    def lap(self, stage):
+        self.stats.lap(stage)
+
+    @property
+    def pids(self):
+        if self._pids is None:
+            self._pids = self.tracker.get_pids() if self.tracker else []
+            self.stats.lap("pid_scan")
+        return self._pids
+
+    @property
+    def pid_set(self):
+        if self._pid_set is None:
+            self._pid_set = set(self.pids)
+        return self._pid_set
+
+class CollectorLoop:
+    """
+    一个调度器 + 一个写入器驱动任意组合的 Collector。
+    Host/Device/统一 Agent 都走这一循环，区别只在装载的插件。
+    某个插件抛异常只影响它自己的本 tick 数据 (首次异常打印一次)。
+    首个 tick 完成后写 ready 标记，写入器关闭 (已 fsync) 后写 done 标记。
+    """
+    def __init__(self, tag, writer, collectors, interval, stats_file, tracker=None):
+        self.tag = tag
+        self.writer = writer
+        self.collectors = list(collectors)
+        self.interval = interval
+        self.stats_file = stats_file
+        self.tracker = tracker
+
+        # 阶段顺序即 agent_stats 列顺序; pid_scan 排在第一个需要 PID 的插件之前
+        self.stages = []
+        for c in self.collectors:
+            if c.needs_pids and tracker is not None and "pid_scan" not in self.stages:
+                self.stages.append("pid_scan")
+            self.stages.extend(s for s in c.stages if s not in self.stages)
+
+    def run(self, is_running):
+        sched = DeadlineScheduler(self.interval)
+        stats = AgentStats(self.stages, self.stats_file)
+        ctx = TickContext(self.writer, stats, self.tracker)
+        failed = set()
+        ready = False
+        try:
+            print(f"[{self.tag}] 进入监控循环, 插件: {[c.name for c in self.collectors]}")
+            sched.wait()
+            while is_running():
+                ctx.begin(now_ns())
+                stats.start()
+                for c in self.collectors:
+                    try:
+                        c.collect(ctx)
+                    except Exception as e:
+                        if c.name not in failed:
+                            failed.add(c.name)
+                            print(f"⚠️ [{self.tag}] 插件 {c.name} 采集失败: {e}")
+                    if c.stages: stats.lap(c.stages[-1])
+
+                stats.finish(self.writer, ctx.ts, sched.missed)
+                if not ready:
+                    self.writer.mark("ready")
+                    ready = True
+                sched.wait()
+        except Exception as e:
+            print(f"❌ Error: {e}")
+        finally:
+            for c in self.collectors:
+                try: c.close()
+                except: pass
+            self.writer.close()
+            self.writer.mark("done")
+            print(f"[{self.tag}] 共采样 {sched.ticks} 个 tick, 错过 {sched.missed} 个")
+            print(f"[{self.tag}] 自身开销: {stats.summary(sched.missed)}")
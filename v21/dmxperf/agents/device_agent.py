@@ -1,15 +1,19 @@
 # -*- coding: utf-8 -*-
 import argparse
 import time
-import datetime
 import os
 import signal
 import socket
-import threading
-import queue
 import ctypes
+import queue
+import threading
 from ctypes import *
 
+try:
+    from dmxperf.agents.agent_common import AsyncWriter, Collector, CollectorLoop, PidMatcher, register_agent
+except ImportError:
+    from agent_common import AsyncWriter, Collector, CollectorLoop, PidMatcher, register_agent
+
 running = True
 def handle_signal(s, f): global running; running = False
 
@@ -35,18 +39,115 @@ class NvmlStructs:
     class nvmlProcessInfo_t(Structure):
         _fields_ = [("pid", c_uint), ("usedGpuMemory", c_ulonglong)]
 
-class NvmlNative:
+    class nvmlMemory_t(Structure):
+        _fields_ = [("total", c_ulonglong), ("free", c_ulonglong), ("used", c_ulonglong)]
+
+    class nvmlProcessUtilizationSample_t(Structure):
+        _fields_ = [("pid", c_uint), ("timeStamp", c_ulonglong), ("smUtil", c_uint),
+                    ("memUtil", c_uint), ("encUtil", c_uint), ("decUtil", c_uint)]
+
+    class nvmlValue_t(Union):
+        _fields_ = [("dVal", c_double), ("uiVal", c_uint), ("ulVal", c_ulong),
+                    ("ullVal", c_ulonglong), ("sllVal", c_longlong), ("siVal", c_int)]
+
+    class nvmlFieldValue_t(Structure):
+        pass
+
+NvmlStructs.nvmlFieldValue_t._fields_ = [("fieldId", c_uint), ("scopeId", c_uint),
+                                         ("timestamp", c_longlong), ("latencyUsec", c_longlong),
+                                         ("valueType", c_int), ("nvmlReturn", c_int),
+                                         ("value", NvmlStructs.nvmlValue_t)]
+
+class _NvmlScratch:
+    """单个线程复用的 NVML 输出缓冲"""
     def __init__(self):
-        self.lib = None
-        self.NVML_SUCCESS = 0
-        try:
-            self.lib = CDLL("libnvidia-ml.so.1")
-        except OSError:
+        self.util = NvmlStructs.nvmlUtilization_t()
+        self.power = c_uint()
+        self.mem = NvmlStructs.nvmlMemory_t()
+        self.proc_cap = 16
+        self.procs = (NvmlStructs.nvmlProcessInfo_t * self.proc_cap)()
+        self.proc_count = c_uint()
+        self.uint = c_uint()
+        self.util_cap = 32
+        self.util_samples = (NvmlStructs.nvmlProcessUtilizationSample_t * self.util_cap)()
+        self.util_count = c_uint()
+        self.ull = c_ulonglong()
+
+class NvmlNative:
+    """
+    NVML 的 ctypes 绑定。所有用到的函数在加载时一次性声明 argtypes/restype 并绑定为属性，
+    每次调用不再经过 CDLL 的属性查找与参数类型推断；输出结构体预先分配、逐 tick 复用。
+    lib 可注入任意提供同名函数的对象 (如用 Python 实现的替身库)，用于无 GPU 环境下测试。
+    """
+    NVML_SUCCESS = 0
+    NVML_ERROR_NOT_SUPPORTED = 3
+    NVML_ERROR_NOT_FOUND = 6
+    NVML_ERROR_INSUFFICIENT_SIZE = 7
+
+    # 函数名 -> argtypes (restype 均为 nvmlReturn_t = c_int)
+    PROTOTYPES = {
+        "nvmlInit": [],
+        "nvmlShutdown": [],
+        "nvmlDeviceGetCount_v2": [POINTER(c_uint)],
+        "nvmlDeviceGetHandleByIndex_v2": [c_uint, POINTER(c_void_p)],
+        "nvmlDeviceGetPciInfo_v3": [c_void_p, POINTER(NvmlStructs.nvmlPciInfo_t)],
+        "nvmlDeviceGetName": [c_void_p, c_char_p, c_uint],
+        "nvmlDeviceGetUtilizationRates": [c_void_p, POINTER(NvmlStructs.nvmlUtilization_t)],
+        "nvmlDeviceGetPowerUsage": [c_void_p, POINTER(c_uint)],
+        "nvmlDeviceGetMemoryInfo": [c_void_p, POINTER(NvmlStructs.nvmlMemory_t)],
+        "nvmlDeviceGetTotalEnergyConsumption": [c_void_p, POINTER(c_ulonglong)],
+        "nvmlDeviceGetComputeRunningProcesses": [c_void_p, POINTER(c_uint), POINTER(NvmlStructs.nvmlProcessInfo_t)],
+        "nvmlDeviceGetClockInfo": [c_void_p, c_int, POINTER(c_uint)],
+        "nvmlDeviceGetTemperature": [c_void_p, c_int, POINTER(c_uint)],
+        "nvmlDeviceGetCurrentClocksThrottleReasons": [c_void_p, POINTER(c_ulonglong)],
+        "nvmlDeviceGetFieldValues": [c_void_p, c_int, POINTER(NvmlStructs.nvmlFieldValue_t)],
+        "nvmlDeviceGetProcessUtilization": [c_void_p, POINTER(NvmlStructs.nvmlProcessUtilizationSample_t),
+                                            POINTER(c_uint), c_ulonglong],
+    }
+    NVML_CLOCK_SM = 1
+    NVML_CLOCK_MEM = 2
+    NVML_TEMPERATURE_GPU = 0
+    NVML_SCOPE_ALL_LINKS = 0xFFFFFFFF
+
+    def __init__(self, lib=None):
+        self.lib = lib
+        self.fn = {}
+        if self.lib is None:
             try:
-                self.lib = CDLL("libnvidia-ml.so")
+                self.lib = CDLL("libnvidia-ml.so.1")
             except OSError:
-                print("❌ 无法加载 libnvidia-ml.so，请确保安装了 NVIDIA 驱动。")
-                return
+                try:
+                    self.lib = CDLL("libnvidia-ml.so")
+                except OSError:
+                    print("❌ 无法加载 libnvidia-ml.so，请确保安装了 NVIDIA 驱动。")
+                    return
+        self._declare()
+        # 逐 tick 复用的输出缓冲按线程各一份 (看门狗为每张卡一个工作线程)
+        self._tls = threading.local()
+
+    def _scratch(self):
+        b = getattr(self._tls, "b", None)
+        if b is None:
+            b = self._tls.b = _NvmlScratch()
+        return b
+
+    def _declare(self):
+        for name, argtypes in self.PROTOTYPES.items():
+            try:
+                f = getattr(self.lib, name)
+            except AttributeError:
+                continue  # 旧驱动缺少的符号: 调用时按不支持处理
+            try:
+                f.argtypes = argtypes
+                f.restype = c_int
+            except (AttributeError, TypeError): pass
+            self.fn[name] = f
+
+    def _call(self, name, *args):
+        f = self.fn.get(name)
+        if f is None:
+            raise RuntimeError(f"NVML 函数不可用: {name}")
+        return f(*args)
 
     def check_error(self, ret):
         if ret != self.NVML_SUCCESS:
@@ -54,155 +155,527 @@ class NvmlNative:
 
     def init(self):
         if not self.lib: return
-        self.check_error(self.lib.nvmlInit())
+        self.check_error(self._call("nvmlInit"))
 
     def shutdown(self):
         if not self.lib: return
-        try: self.lib.nvmlShutdown()
+        try: self._call("nvmlShutdown")
         except: pass
 
     def device_get_count(self):
         count = c_uint()
-        self.check_error(self.lib.nvmlDeviceGetCount_v2(byref(count)))
+        self.check_error(self._call("nvmlDeviceGetCount_v2", byref(count)))
         return count.value
 
     def device_get_handle_by_index(self, index):
         handle = c_void_p()
-        self.check_error(self.lib.nvmlDeviceGetHandleByIndex_v2(index, byref(handle)))
+        self.check_error(self._call("nvmlDeviceGetHandleByIndex_v2", index, byref(handle)))
         return handle
 
     def device_get_pci_info(self, handle):
         pci = NvmlStructs.nvmlPciInfo_t()
-        self.check_error(self.lib.nvmlDeviceGetPciInfo_v3(handle, byref(pci)))
+        self.check_error(self._call("nvmlDeviceGetPciInfo_v3", handle, byref(pci)))
         return pci.busId.decode("utf-8")
 
+    def device_get_name(self, handle):
+        buf = create_string_buffer(96)
+        try:
+            if self._call("nvmlDeviceGetName", handle, buf, 96) == self.NVML_SUCCESS:
+                return buf.value.decode("utf-8", errors="ignore")
+        except: pass
+        return ""
+
     def device_get_utilization_rates(self, handle):
-        util = NvmlStructs.nvmlUtilization_t()
-        self.check_error(self.lib.nvmlDeviceGetUtilizationRates(handle, byref(util)))
-        return util.gpu
+        b = self._scratch()
+        self.check_error(self._call("nvmlDeviceGetUtilizationRates", handle, byref(b.util)))
+        return b.util.gpu
 
     def device_get_power_usage(self, handle):
-        power = c_uint() # mW
+        # mW
+        b = self._scratch()
         try:
-            ret = self.lib.nvmlDeviceGetPowerUsage(handle, byref(power))
-            if ret == self.NVML_SUCCESS: return power.value
+            if self._call("nvmlDeviceGetPowerUsage", handle, byref(b.power)) == self.NVML_SUCCESS:
+                return b.power.value
         except: pass
         return 0
 
-    def device_get_compute_running_processes(self, handle):
-        count = c_uint(0)
-        ret = self.lib.nvmlDeviceGetComputeRunningProcesses(handle, byref(count), None)
-        if count.value == 0: return []
-        procs = (NvmlStructs.nvmlProcessInfo_t * count.value)()
-        ret = self.lib.nvmlDeviceGetComputeRunningProcesses(handle, byref(count), procs)
-        if ret != self.NVML_SUCCESS: return []
-        result = []
-        for i in range(count.value):
-            result.append({'pid': procs[i].pid, 'usedGpuMemory': procs[i].usedGpuMemory})
-        return result
+    def device_get_memory_info(self, handle):
+        """返回 (used, total) 字节"""
+        b = self._scratch()
+        self.check_error(self._call("nvmlDeviceGetMemoryInfo", handle, byref(b.mem)))
+        return b.mem.used, b.mem.total
 
-# ==============================================================================
-# 2. AsyncWriter (修复了 NFS 同步问题)
-# ==============================================================================
-class AsyncWriter:
-    def __init__(self, root, node):
-        self.q = queue.Queue()
-        self.node_dir = os.path.join(root, node)
-        os.makedirs(self.node_dir, exist_ok=True)
-        self.t = threading.Thread(target=self._loop, daemon=True)
-        self.t.start()
-        self.files = {}
-        self.node_name = node
-
-    def write(self, pid, filename, ts, val, header="Timestamp,Value"):
-        path = os.path.join(self.node_dir, f"{self.node_name}-PID{pid}", filename)
-        self.q.put((path, header, f"{ts},{val}\n"))
-
-    def _loop(self):
-        while True:
-            item = self.q.get()
-            if item is None: break
-            path, header, line = item
-            if path not in self.files:
-                try:
-                    os.makedirs(os.path.dirname(path), exist_ok=True)
-                    f = open(path, 'a', buffering=1)
-                    self.files[path] = f
-                    if os.path.getsize(path) == 0: f.write(f"{header}\n")
-                except Exception as e:
-                    continue
-            try:
-                self.files[path].write(line)
-            except: pass
+    def device_get_total_energy(self, handle):
+        """驱动加载以来的累计能耗 (mJ)，Volta 之前的卡不支持时返回 None"""
+        b = self._scratch()
+        if self._call("nvmlDeviceGetTotalEnergyConsumption", handle, byref(b.ull)) == self.NVML_SUCCESS:
+            return b.ull.value
+        return None
 
-    def close(self):
-        # 1. 停止处理
-        self.q.put(None)
-        self.t.join()
-        
-        # 2. [关键修改] 强制刷盘，确保数据写入 NFS
-        print(f"💾 [AsyncWriter] 正在强制同步 {len(self.files)} 个文件到磁盘...")
-        for f in self.files.values():
-            try:
-                f.flush()
-                os.fsync(f.fileno()) # 强制写入磁盘
-            except: pass
-            f.close()
+    def device_get_clock(self, handle, clock_type):
+        """当前时钟 (MHz)，不支持时返回 None"""
+        b = self._scratch()
+        if self._call("nvmlDeviceGetClockInfo", handle, clock_type, byref(b.uint)) == self.NVML_SUCCESS:
+            return b.uint.value
+        return None
+
+    def device_get_temperature(self, handle):
+        b = self._scratch()
+        if self._call("nvmlDeviceGetTemperature", handle, self.NVML_TEMPERATURE_GPU, byref(b.uint)) == self.NVML_SUCCESS:
+            return b.uint.value
+        return None
+
+    def device_get_throttle_reasons(self, handle):
+        b = self._scratch()
+        if self._call("nvmlDeviceGetCurrentClocksThrottleReasons", handle, byref(b.ull)) == self.NVML_SUCCESS:
+            return b.ull.value
+        return None
+
+    def make_field_request(self, fields):
+        """按 [(fieldId, scopeId), ...] 预先构造请求数组，之后每 tick 复用"""
+        arr = (NvmlStructs.nvmlFieldValue_t * len(fields))()
+        for i, (fid, scope) in enumerate(fields):
+            arr[i].fieldId = fid
+            arr[i].scopeId = scope
+        return arr
+
+    def device_get_field_values(self, handle, arr):
+        """
+        一次调用取回整组字段。返回与请求对齐的 [(value, timestamp_us) | None]，
+        单个字段不支持 (nvmlReturn != SUCCESS) 时对应位置为 None。
+        """
+        if self._call("nvmlDeviceGetFieldValues", handle, len(arr), arr) != self.NVML_SUCCESS:
+            return [None] * len(arr)
+        res = []
+        for fv in arr:
+            if fv.nvmlReturn != self.NVML_SUCCESS:
+                res.append(None)
+                continue
+            t = fv.valueType
+            v = fv.value
+            val = (v.dVal if t == 0 else v.uiVal if t == 1 else v.ulVal if t == 2 else
+                   v.ullVal if t == 3 else v.sllVal if t == 4 else v.siVal)
+            res.append((val, fv.timestamp))
+        return res
+
+    def device_get_process_utilization(self, handle, last_seen):
+        """
+        取时间戳晚于 last_seen (微秒) 的进程利用率采样，返回 [(pid, timeStamp, smUtil), ...]；
+        自上次以来没有新采样 (NVML_ERROR_NOT_FOUND) 时返回 []。
+        驱动/设备不支持时抛出 NotImplementedError，其余错误抛出 RuntimeError。
+        """
+        if "nvmlDeviceGetProcessUtilization" not in self.fn:
+            raise NotImplementedError
+        b = self._scratch()
+        for _ in range(2):
+            b.util_count.value = b.util_cap
+            ret = self._call("nvmlDeviceGetProcessUtilization", handle, b.util_samples,
+                             byref(b.util_count), last_seen)
+            if ret == self.NVML_SUCCESS:
+                s = b.util_samples
+                return [(s[i].pid, s[i].timeStamp, s[i].smUtil) for i in range(b.util_count.value)]
+            if ret == self.NVML_ERROR_NOT_FOUND:
+                return []
+            if ret == self.NVML_ERROR_NOT_SUPPORTED:
+                raise NotImplementedError
+            if ret != self.NVML_ERROR_INSUFFICIENT_SIZE:
+                self.check_error(ret)
+            b.util_cap = max(b.util_cap * 2, b.util_count.value + 8)
+            b.util_samples = (NvmlStructs.nvmlProcessUtilizationSample_t * b.util_cap)()
+        return []
+
+    def device_get_compute_running_processes(self, handle):
+        """
+        复用按历史最大进程数分配的缓冲，通常一次调用即可取回列表；
+        缓冲不足 (NVML_ERROR_INSUFFICIENT_SIZE) 时按返回的数量扩容重试一次。
+        """
+        b = self._scratch()
+        for _ in range(2):
+            b.proc_count.value = b.proc_cap
+            ret = self._call("nvmlDeviceGetComputeRunningProcesses", handle, byref(b.proc_count), b.procs)
+            if ret == self.NVML_SUCCESS:
+                procs = b.procs
+                return [{'pid': procs[i].pid, 'usedGpuMemory': procs[i].usedGpuMemory}
+                        for i in range(b.proc_count.value)]
+            if ret != self.NVML_ERROR_INSUFFICIENT_SIZE:
+                return []
+            b.proc_cap = max(b.proc_cap * 2, b.proc_count.value + 8)
+            b.procs = (NvmlStructs.nvmlProcessInfo_t * b.proc_cap)()
+        return []
 
 # ==============================================================================
-# 3. NativeNvmlManager - 业务逻辑层
+# 2. NativeNvmlManager - 业务逻辑层
 # ==============================================================================
 class NativeNvmlManager:
-    def __init__(self):
-        self.nvml = NvmlNative()
+    """
+    初始化时一次性解析每张卡的句柄、PCI 总线号与名称 (运行期间不变)，
+    之后每 tick 调用 sample() 单次遍历设备，同时返回设备状态与进程列表。
+
+    每卡每 tick 采集利用率、功耗、累计能耗、显存占用/总量、SM/显存时钟与 GPU 温度；
+    detail=True 时额外采集降频原因位掩码，以及通过一次 nvmlDeviceGetFieldValues 批量读取的 PCIe / NVLink 累计字节与显存温度，
+    累计量按字段自带的时间戳差分成 MB/s。
+    """
+    # (键, fieldId, scopeId, 每计数单位字节数; None 表示瞬时值)
+    DETAIL_FIELDS = [("pcie_tx", 197, 0, 1),                                # NVML_FI_DEV_PCIE_COUNT_TX_BYTES
+                     ("pcie_rx", 198, 0, 1),                                # NVML_FI_DEV_PCIE_COUNT_RX_BYTES
+                     ("nvlink_tx", 138, NvmlNative.NVML_SCOPE_ALL_LINKS, 1024),  # NVLINK_THROUGHPUT_DATA_TX (KiB)
+                     ("nvlink_rx", 139, NvmlNative.NVML_SCOPE_ALL_LINKS, 1024),  # NVLINK_THROUGHPUT_DATA_RX (KiB)
+                     ("dram_temp", 82, 0, None)]                            # NVML_FI_DEV_MEMORY_TEMP
+
+    def __init__(self, lib=None, detail=False):
+        self.nvml = NvmlNative(lib)
+        self.detail = detail
+        self.field_req = {}   # bus_id -> 复用的 nvmlFieldValue_t 数组
+        self.prev_fields = {} # bus_id -> 上一 tick 的 [(value, timestamp_us) | None]
         self.available = False
         self.device_count = 0
+        self.devices = []  # [{'id', 'handle', 'bus_id', 'name'}]
         if self.nvml.lib:
             try:
                 self.nvml.init()
                 self.device_count = self.nvml.device_get_count()
+                for i in range(self.device_count):
+                    try:
+                        handle = self.nvml.device_get_handle_by_index(i)
+                        self.devices.append({'id': i, 'handle': handle,
+                                             'bus_id': self.nvml.device_get_pci_info(handle),
+                                             'name': self.nvml.device_get_name(handle),
+                                             # 进程级利用率: 是否支持 / 已见到的最新采样时间戳 / 上次结果
+                                             'proc_util_ok': True, 'last_seen': 0, 'proc_util': {}})
+                    except Exception as e:
+                        print(f"[DeviceAgent] ⚠️ GPU {i} 句柄获取失败, 跳过: {e}")
                 self.available = True
                 print(f"[DeviceAgent] ✅ Native NVML (ctypes) 初始化成功，检测到 {self.device_count} 个 GPU。")
             except Exception as e:
                 print(f"[DeviceAgent] ❌ NVML Init Failed: {e}")
 
-    def get_gpu_states(self):
-        if not self.available: return {}
+    def sample(self):
+        """
+        返回 (gpu_map, procs): gpu_map 为
+        {bus_id: {'id', 'util', 'power', 'energy', 'mem_used', 'mem_total', 'sm_clock', 'dram_clock', 'temp',
+                  ['proc_util']}}，energy 为累计毫焦，
+        procs 为 [{'pid', 'bus_id', 'mem'}]。proc_util 为 {pid: SM 利用率%}，仅在驱动支持进程级采样时存在。
+        gpu_map 覆盖所有卡 (无论是否有进程)，供设备级序列使用。
+        """
         gpu_map = {}
-        for i in range(self.device_count):
-            try:
-                handle = self.nvml.device_get_handle_by_index(i)
-                bus_id = self.nvml.device_get_pci_info(handle)
-                
-                try: util = self.nvml.device_get_utilization_rates(handle)
-                except: util = 0.0
-                
-                try: power = self.nvml.device_get_power_usage(handle) / 1000.0
-                except: power = 0.0
-                
-                gpu_map[bus_id] = {'id': i, 'util': util, 'power': power}
-            except: continue
-        return gpu_map
-
-    def get_active_processes(self):
-        if not self.available: return []
         procs = []
-        for i in range(self.device_count):
-            try:
-                handle = self.nvml.device_get_handle_by_index(i)
-                bus_id = self.nvml.device_get_pci_info(handle)
-                
-                raw_procs = self.nvml.device_get_compute_running_processes(handle)
-                for p in raw_procs:
-                    mem_mib = p['usedGpuMemory'] / 1024.0 / 1024.0
-                    procs.append({'pid': p['pid'], 'bus_id': bus_id, 'mem': mem_mib})
-            except: continue
-        return procs
+        if not self.available: return gpu_map, procs
+        for dev in self.devices:
+            info, dev_procs = self.sample_device(dev)
+            gpu_map[dev['bus_id']] = info
+            procs.extend(dev_procs)
+        return gpu_map, procs
+
+    def sample_device(self, dev):
+        """采集单张卡，返回 (info, procs)；只读写该卡自己的状态，可在每卡独立的线程中调用"""
+        nvml = self.nvml
+        handle = dev['handle']
+        bus_id = dev['bus_id']
+        try: util = nvml.device_get_utilization_rates(handle)
+        except: util = 0.0
+
+        try: power = nvml.device_get_power_usage(handle) / 1000.0
+        except: power = 0.0
+
+        info = {'id': dev['id'], 'util': util, 'power': power}
+        try: used, total = nvml.device_get_memory_info(handle)
+        except: used = total = None
+        info['mem_used'] = None if used is None else used / 1048576.0
+        info['mem_total'] = None if total is None else total / 1048576.0
+        for key, fn, arg in (("sm_clock", nvml.device_get_clock, nvml.NVML_CLOCK_SM),
+                             ("dram_clock", nvml.device_get_clock, nvml.NVML_CLOCK_MEM)):
+            try: info[key] = fn(handle, arg)
+            except: info[key] = None
+        try: info['temp'] = nvml.device_get_temperature(handle)
+        except: info['temp'] = None
+        try: info['energy'] = nvml.device_get_total_energy(handle)
+        except: info['energy'] = None
+        if self.detail:
+            info.update(self._sample_detail(handle, bus_id))
+
+        try:
+            dev_procs = nvml.device_get_compute_running_processes(handle)
+        except:
+            return info, []
+        procs = [{'pid': p['pid'], 'bus_id': bus_id, 'mem': p['usedGpuMemory'] / 1048576.0} for p in dev_procs]
+        if dev_procs and dev['proc_util_ok']:
+            pu = self._sample_proc_util(dev)
+            if pu is not None: info['proc_util'] = pu
+        return info, procs
+
+    def _sample_proc_util(self, dev):
+        """
+        按 last_seen 增量读取进程级 SM 利用率，同一 PID 多个新采样取平均。
+        本次有新采样时，未出现的 PID 视为 0 (NVML 只为在卡上运行过的进程记录采样)；
+        采样间隔短于 NVML 内部采样周期、本次无任何新采样时沿用上次结果。
+        不支持时返回 None，此后该卡回退为设备级利用率。
+        """
+        try:
+            samples = self.nvml.device_get_process_utilization(dev['handle'], dev['last_seen'])
+        except NotImplementedError:
+            dev['proc_util_ok'] = False
+            print(f"[DeviceAgent] ⚠️ GPU {dev['id']} 不支持进程级利用率采样，回退为设备利用率")
+            return None
+        except Exception:
+            return None
+        if not samples:
+            return dev['proc_util']
+        acc = {}
+        for pid, ts, sm in samples:
+            a = acc.setdefault(pid, [0, 0])
+            a[0] += sm
+            a[1] += 1
+            if ts > dev['last_seen']: dev['last_seen'] = ts
+        dev['proc_util'] = {pid: round(t / n, 1) for pid, (t, n) in acc.items()}
+        return dev['proc_util']
+
+    def _sample_detail(self, handle, bus_id):
+        nvml = self.nvml
+        res = {}
+        try: res['throttle'] = nvml.device_get_throttle_reasons(handle)
+        except: res['throttle'] = None
+
+        req = self.field_req.get(bus_id)
+        if req is None:
+            req = self.field_req[bus_id] = nvml.make_field_request([(f, sc) for _, f, sc, _ in self.DETAIL_FIELDS])
+        try: cur = nvml.device_get_field_values(handle, req)
+        except: cur = [None] * len(self.DETAIL_FIELDS)
+        prev = self.prev_fields.get(bus_id)
+        self.prev_fields[bus_id] = cur
+
+        for i, (key, _, _, unit) in enumerate(self.DETAIL_FIELDS):
+            c = cur[i]
+            if unit is None:
+                res[key] = c[0] if c else None
+                continue
+            p = prev[i] if prev else None
+            # 累计计数: 首个 tick、字段不支持、计数回退 (驱动重载) 时留空
+            if c and p and c[1] > p[1] and c[0] >= p[0]:
+                res[key] = (c[0] - p[0]) * unit / 1048576.0 / ((c[1] - p[1]) / 1e6)
+            else:
+                res[key] = None
+        return res
 
     def shutdown(self):
         if self.available:
             self.nvml.shutdown()
 
+class _DeviceWorker(threading.Thread):
+    """单卡 NVML 工作线程: 一次只执行一个采样任务，挂住的调用只卡住本卡"""
+    def __init__(self, fn, dev):
+        super().__init__(daemon=True, name=f"nvml-gpu{dev['id']}")
+        self.fn = fn
+        self.dev = dev
+        self.jobs = queue.Queue()
+        self.done = threading.Event()
+        self.busy = False
+        self.result = None
+        self.started_at = 0.0
+        self.finished_at = 0.0
+        self.start()
+
+    def submit(self):
+        self.busy = True
+        self.result = None
+        self.done.clear()
+        self.started_at = time.monotonic()
+        self.jobs.put(True)
+
+    def run(self):
+        while self.jobs.get():
+            try: self.result = self.fn(self.dev)
+            except Exception: self.result = None
+            self.finished_at = time.monotonic()
+            self.busy = False
+            self.done.set()
+
+    def stop(self):
+        self.jobs.put(False)
+
+class NvmlWatchdog:
+    """
+    NVML 调用看门狗: 每张卡一个工作线程，主循环为本 tick 到期的卡派发采样任务，
+    统一等到截止时间 (tick 开始 + timeout) 为止。
+      - 超时的卡标记为 degraded，此后每 degraded_every 个 tick 才采样一次；
+        其工作线程仍卡在 NVML 里时不再派发，避免任务堆积
+      - degraded 卡连续 recover_after 次按时返回后恢复正常频率
+      - 事件 (timeout / returned / recovered) 由 poll_events() 取走，写入 nvml_events.csv
+    健康的卡不受影响，仍按采样间隔采集。
+    """
+    def __init__(self, manager, timeout, degraded_every=10, recover_after=3):
+        self.manager = manager
+        self.timeout = timeout
+        self.degraded_every = max(1, degraded_every)
+        self.recover_after = max(1, recover_after)
+        self.tick = 0
+        self.events = []  # (gpu, bus_id, event, elapsed_ms)
+        self.workers = []
+        self.state = {}   # bus_id -> {'degraded', 'ok_streak', 'hung'}
+        if manager.available:
+            for dev in manager.devices:
+                self.workers.append(_DeviceWorker(manager.sample_device, dev))
+                self.state[dev['bus_id']] = {'degraded': False, 'ok_streak': 0, 'hung': False}
+
+    def _event(self, dev, name, elapsed):
+        self.events.append((dev['id'], dev['bus_id'], name, round(elapsed * 1000, 1)))
+
+    def sample(self):
+        """与 NativeNvmlManager.sample() 返回值一致，但只包含本 tick 按时返回的卡"""
+        self.tick += 1
+        deadline = time.monotonic() + self.timeout
+        submitted = []
+        for w in self.workers:
+            st = self.state[w.dev['bus_id']]
+            if w.busy: continue
+            if st['hung']:
+                # 之前超时的调用终于返回
+                st['hung'] = False
+                self._event(w.dev, "returned", w.finished_at - w.started_at)
+            if st['degraded'] and self.tick % self.degraded_every: continue
+            w.submit()
+            submitted.append(w)
+
+        gpu_map = {}
+        procs = []
+        for w in submitted:
+            dev = w.dev
+            st = self.state[dev['bus_id']]
+            if not w.done.wait(max(0.0, deadline - time.monotonic())):
+                st['hung'] = True
+                st['degraded'] = True
+                st['ok_streak'] = 0
+                self._event(dev, "timeout", time.monotonic() - w.started_at)
+                print(f"[DeviceAgent] ⚠️ GPU {dev['id']} ({dev['bus_id']}) NVML 调用超时，降频采样")
+                continue
+            if w.result is None: continue
+            if st['degraded']:
+                st['ok_streak'] += 1
+                if st['ok_streak'] >= self.recover_after:
+                    st['degraded'] = False
+                    self._event(dev, "recovered", w.finished_at - w.started_at)
+                    print(f"[DeviceAgent] GPU {dev['id']} ({dev['bus_id']}) NVML 恢复正常")
+            info, dev_procs = w.result
+            gpu_map[dev['bus_id']] = info
+            procs.extend(dev_procs)
+        return gpu_map, procs
+
+    def poll_events(self):
+        ev, self.events = self.events, []
+        return ev
+
+    def stuck(self):
+        return any(w.busy for w in self.workers)
+
+    def close(self):
+        for w in self.workers:
+            w.stop()
+
+# ==============================================================================
+# 3. GpuCollector - 采集插件 (统一 Agent 也装载该插件)
+# ==============================================================================
+class GpuCollector(Collector):
+    """
+    NVML 列出的计算进程中属于目标作业的，按卡写 gpu<N>.csv。
+    目标判定与 Host Agent 共用 PidMatcher 规则: 统一 Agent 中直接使用 ProcessTracker 的实例 (两边结论一致)，
+    独立运行的 Device Agent 使用自己的实例；按 (pid, 启动时间) 缓存，进程离开 NVML 列表时剔除。
+    detail=True (--gpu_detail) 时追加时钟/温度/降频原因/PCIe/NVLink 列
+    (列名避开 "mem"/"util"，Reporter 按子串挑选显存与利用率列)。
+
+    另外每 tick 为节点上所有卡写一行 gpu_devices.csv (与是否匹配到目标进程无关)，
+    用于发现闲置卡 / 被其他进程占用的卡 / 作业 CUDA 上下文建立之前的时段。
+    该文件的 GPU 列即 gpu<N>.csv 中的 N，BusId 列为 PCI 总线号，进程级数据经此按总线号关联。
+
+    nvml_timeout 不为 None 时 NVML 调用经 NvmlWatchdog 执行，超时/恢复事件写入 nvml_events.csv。
+    """
+    name = "gpu"
+    stages = ("nvml", "pid_match")
+    GPU_HEADER = "Timestamp,Memory(MiB),Util(%),Power(W)"
+    DEVICE_HEADER = ("Timestamp,GPU,BusId,Util(%),MemUsed(MiB),MemTotal(MiB),Power(W),"
+                     "SmClock(MHz),DramClock(MHz),Temp(C),Energy(J)")
+    EVENT_HEADER = "Timestamp,GPU,BusId,Event,Elapsed_ms"
+    # (gpu_map 键, 列名, 格式)
+    DETAIL_COLS = [("sm_clock", "SmClock(MHz)", "{}"), ("dram_clock", "DramClock(MHz)", "{}"),
+                   ("temp", "Temp(C)", "{}"), ("dram_temp", "DramTemp(C)", "{}"),
+                   ("throttle", "ThrottleReasons", "{}"),
+                   ("pcie_rx", "PcieRx(MBps)", "{:.2f}"), ("pcie_tx", "PcieTx(MBps)", "{:.2f}"),
+                   ("nvlink_rx", "NvlinkRx(MBps)", "{:.2f}"), ("nvlink_tx", "NvlinkTx(MBps)", "{:.2f}")]
+
+    def __init__(self, target_name, nvml_lib=None, detail=False, nvml_timeout=None):
+        self.target_name = target_name
+        self.my_pid = os.getpid()
+        self.detail = detail
+        self.matcher = PidMatcher(target_name)
+        self.nvml_pids = set()   # 上一 tick NVML 列出的计算进程
+        self.nv_manager = NativeNvmlManager(nvml_lib, detail=detail)
+        self.watchdog = NvmlWatchdog(self.nv_manager, nvml_timeout) if nvml_timeout is not None else None
+        self.header = self.GPU_HEADER
+        if detail:
+            self.header += "".join(f",{c}" for _, c, _ in self.DETAIL_COLS)
+
+    def _detail_vals(self, gpu_info):
+        vals = []
+        for key, _, fmt in self.DETAIL_COLS:
+            v = gpu_info.get(key)
+            vals.append("" if v is None else fmt.format(v))
+        return "," + ",".join(vals)
+
+    def _write_devices(self, ctx, gpu_states):
+        for bus_id, g in gpu_states.items():
+            vals = [g['id'], bus_id, g['util'],
+                    "" if g['mem_used'] is None else f"{g['mem_used']:.1f}",
+                    "" if g['mem_total'] is None else f"{g['mem_total']:.1f}",
+                    f"{g['power']:.1f}"]
+            vals += ["" if g[k] is None else g[k] for k in ("sm_clock", "dram_clock", "temp")]
+            # 累计能耗计数 (驱动加载以来)，分析阶段按时间窗差分得到精确焦耳数
+            vals.append("" if g['energy'] is None else f"{g['energy'] / 1000.0:.3f}")
+            ctx.writer.write("", "gpu_devices.csv", ctx.ts, ",".join(str(v) for v in vals), self.DEVICE_HEADER)
+
+    def collect(self, ctx):
+        if self.watchdog:
+            gpu_states, active_procs = self.watchdog.sample()
+            for ev in self.watchdog.poll_events():
+                ctx.writer.write("", "nvml_events.csv", ctx.ts, ",".join(str(v) for v in ev), self.EVENT_HEADER)
+        else:
+            gpu_states, active_procs = self.nv_manager.sample()
+        self._write_devices(ctx, gpu_states)
+        ctx.lap("nvml")
+
+        matcher = ctx.tracker.matcher if ctx.tracker else self.matcher
+        nvml_pids = {p['pid'] for p in active_procs}
+        matcher.forget(self.nvml_pids - nvml_pids)
+        self.nvml_pids = nvml_pids
+
+        if not (active_procs and gpu_states): return
+        known = ctx.pid_set if ctx.tracker else ()
+        for p in active_procs:
+            pid = p['pid']
+            if pid == self.my_pid: continue
+            # 已建立 CUDA 上下文的进程早已 exec，否定结论同样可以缓存
+            if pid not in known and not matcher.match(pid, cache_negative=True): continue
+
+            gpu_info = gpu_states.get(p['bus_id'])
+            if gpu_info is None: continue
+            # 多个 rank 共享一张卡时，Util 取该进程自己的 SM 利用率
+            proc_util = gpu_info.get('proc_util')
+            util = proc_util.get(pid, 0) if proc_util is not None else gpu_info['util']
+            val = f"{p['mem']:.1f},{util},{gpu_info['power']:.1f}"
+            if self.detail: val += self._detail_vals(gpu_info)
+            ctx.writer.write(pid, f"gpu{gpu_info['id']}.csv", ctx.ts, val, self.header)
+
+    def close(self):
+        if self.watchdog:
+            self.watchdog.close()
+            if self.watchdog.stuck():
+                # 仍有线程卡在 NVML 中，nvmlShutdown 可能同样挂住，直接退出由驱动回收
+                print("[DeviceAgent] ⚠️ 存在未返回的 NVML 调用，跳过 nvmlShutdown")
+                return
+        self.nv_manager.shutdown()
+
+def resolve_nvml_timeout(nvml_timeout, interval):
+    """--nvml_timeout: >0 原值; 0 取采样间隔的一半 (至少 50ms); <0 关闭看门狗 (返回 None)"""
+    if nvml_timeout < 0: return None
+    return nvml_timeout if nvml_timeout > 0 else max(0.05, interval * 0.5)
+
 # ==============================================================================
 # 4. DeviceAgent 主逻辑
 # ==============================================================================
@@ -210,54 +683,21 @@ class DeviceAgent:
     def __init__(self, args):
         self.timeseries_root = args.timeseries_root
         self.target_name = args.target_name
-        self.interval = args.interval
+        self.interval = max(0.01, args.interval)
         self.node_name = socket.gethostname()
-        self.writer = AsyncWriter(self.timeseries_root, self.node_name)
-        self.nv_manager = NativeNvmlManager()
-
-    def _check_pid_name(self, pid, target_name):
-        try:
-            with open(f'/proc/{pid}/cmdline', 'rb') as f:
-                cmd = f.read().decode(errors='ignore').replace('\0', ' ').strip()
-                if "device_agent" in cmd: return False 
-                if target_name.lower() in cmd.lower(): return True
-        except: pass
-        return False
+        self.writer = AsyncWriter(self.timeseries_root, self.node_name, args.flush_interval, args.flush_bytes,
+                                  args.layout, "device", args.max_queue, args.queue_policy, state_dir=args.state_dir)
+        self.gpu = GpuCollector(self.target_name, detail=args.gpu_detail,
+                                nvml_timeout=resolve_nvml_timeout(args.nvml_timeout, self.interval))
 
     def run(self):
         signal.signal(signal.SIGTERM, handle_signal)
         signal.signal(signal.SIGINT, handle_signal)
 
         print(f"[DeviceAgent] 启动! 节点: {self.node_name}, 目标: '{self.target_name}' (No-Dep Version)")
-        my_pid = os.getpid()
-
-        try:
-            while running:
-                start = time.time()
-                ts = datetime.datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M:%S")
-                gpu_states = self.nv_manager.get_gpu_states()
-                active_procs = self.nv_manager.get_active_processes()
-
-                if active_procs and gpu_states:
-                    for p in active_procs:
-                        pid = p['pid']
-                        if pid == my_pid: continue
-                        
-                        if self._check_pid_name(pid, self.target_name):
-                            bus_id = p['bus_id']
-                            if bus_id in gpu_states:
-                                gpu_info = gpu_states[bus_id]
-                                gpu_idx = gpu_info['id']
-                                
-                                val = f"{p['mem']:.1f},{gpu_info['util']},{gpu_info['power']:.1f}"
-                                self.writer.write(pid, f"gpu{gpu_idx}.csv", ts, val, "Timestamp,Memory(MiB),Util(%),Power(W)")
-
-                elapsed = time.time() - start
-                time.sleep(max(0.0, self.interval - elapsed))
-        finally:
-            self.nv_manager.shutdown()
-            # 退出时会调用 AsyncWriter.close()，触发 fsync
-            self.writer.close()
+        # 退出时会调用 AsyncWriter.close()，触发 fsync
+        CollectorLoop("DeviceAgent", self.writer, [self.gpu], self.interval,
+                      "agent_stats_device.csv").run(lambda: running)
 
 if __name__ == "__main__":
     p = argparse.ArgumentParser()
@@ -265,7 +705,18 @@ if __name__ == "__main__":
     p.add_argument("--target_name", required=True)
     p.add_argument("--interval", type=float, default=1.0)
     p.add_argument("--gpus_per_proc", type=int, default=1) 
+    p.add_argument("--gpu_detail", action="store_true", help="采集时钟/温度/降频原因/PCIe/NVLink 吞吐")
+    p.add_argument("--nvml_timeout", type=float, default=0.0,
+                   help="单卡 NVML 采样截止时间 (秒); 0 为采样间隔的一半, <0 关闭看门狗")
+    p.add_argument("--flush_interval", type=float, default=5.0, help="缓存最长停留秒数, <=0 为逐行写出")
+    p.add_argument("--flush_bytes", type=int, default=65536, help="单文件缓存达到该字节数即写出")
+    p.add_argument("--layout", choices=["wide", "long"], default="wide", help="long: 进程数据写入单个 device_samples.csv")
+    p.add_argument("--max_queue", type=int, default=50000, help="写队列上限 (条)")
+    p.add_argument("--queue_policy", choices=["block", "drop_oldest", "spill"], default="spill",
+                   help="写队列满时: 阻塞采样 / 丢弃最旧 / 溢出到本地文件")
+    p.add_argument("--state_dir", default=None, help="本次运行的状态目录 (PID 登记与 ready/done 标记)")
     args = p.parse_args()
+    register_agent(args.timeseries_root, args.state_dir, "device")
 
     agent = DeviceAgent(args)
     agent.run()
@@ -2,14 +2,16 @@
 # -*- coding: utf-8 -*-
 import argparse
 import time
-import datetime
 import os
 import signal
 import socket
-import threading
-import queue
 import sys
 
+try:
+    from dmxperf.agents.agent_common import AsyncWriter, Collector, CollectorLoop, PidMatcher, register_agent
+except ImportError:
+    from agent_common import AsyncWriter, Collector, CollectorLoop, PidMatcher, register_agent
+
 running = True
 def handle_signal(s, f):
     global running
@@ -18,71 +20,79 @@ def handle_signal(s, f):
     except: pass
     running = False
 
-class AsyncWriter:
-    def __init__(self, root, node):
-        self.q = queue.Queue()
-        self.node_dir = os.path.join(root, node)
-        self.node_name = node
-        try:
-            os.makedirs(self.node_dir, exist_ok=True)
-            print(f"[AsyncWriter] 数据输出目录: {self.node_dir}")
-        except Exception as e:
-            print(f"❌ 目录创建失败: {e}")
-            raise e
-        self.t = threading.Thread(target=self._loop, daemon=True)
-        self.t.start()
-        self.files = {}
-
-    def write(self, pid, filename, ts, val, header=None):
-        if pid == "" or pid is None:
-            path = os.path.join(self.node_dir, filename)
-        else:
-            path = os.path.join(self.node_dir, f"{self.node_name}-PID{pid}", filename)
-        self.q.put((path, f"{ts},{val}\n", header))
-
-    def _loop(self):
-        while True:
-            item = self.q.get()
-            if item is None: break
-            path, line, header_def = item
-            try:
-                if path not in self.files:
-                    os.makedirs(os.path.dirname(path), exist_ok=True)
-                    f = open(path, 'a', encoding='utf-8', buffering=1)
-                    self.files[path] = f
-                    if os.path.getsize(path) == 0:
-                        hdr = header_def if header_def else "Timestamp,Value"
-                        if not hdr.endswith('\n'): hdr += '\n'
-                        f.write(hdr)
-                        f.flush()
-                self.files[path].write(line)
-            except Exception as e: pass
+class NetworkMonitor:
+    """
+    物理网卡流量速率 (MB/s, MB = 2^20 字节):
+      - 计数文件在初始化时 open 一次，之后每 tick os.pread 重读；
+      - 速率 = 计数增量 / 实测 monotonic 间隔，与采样周期无关；
+      - 32 位计数 (port_rcv_data 等) 的增量按位宽取模，回绕后不再丢样本；
+        计数器停在最大值 (IB 32 位计数饱和) 时该列留空；
+      - 64 位计数不会回绕，变小只能是被清零 (驱动重载/perfquery -R)，按新值计 (与 collect_errors 一致)。
+    """
+    # (rx, tx, 位宽, 单位字节数): *_data 计数以 4 字节 (lane) 为单位
+    IB_CANDIDATES = [("port_rcv_data_64", "port_xmit_data_64", 64, 4),
+                     ("port_rcv_data", "port_xmit_data", 32, 4),
+                     ("rx_bytes", "tx_bytes", 64, 1)]
+    MASK_64 = (1 << 64) - 1
 
-    def close(self):
-        self.q.put(None)
-        self.t.join()
-        for f in self.files.values():
-            try: f.close()
-            except: pass
+    # 可选错误/拥塞计数组 (--ib_errors): (子目录, 计数名, 位宽)
+    # counters/ 区分拥塞 (xmit_wait) 与链路故障，为 PortCounters 定宽计数，打满后停在最大值不回绕
+    # (sysfs 无对应的 64 位扩展计数)；hw_counters/ 为 RDMA 重传相关计数 (mlx5 驱动 64 位计数)
+    IB_ERROR_COUNTERS = [("counters", "port_xmit_wait", 32), ("counters", "port_xmit_discards", 16),
+                         ("counters", "symbol_error", 16), ("counters", "link_downed", 8),
+                         ("hw_counters", "local_ack_timeout_err", 64), ("hw_counters", "rnr_nak_retry_err", 64),
+                         ("hw_counters", "packet_seq_err", 64), ("hw_counters", "implied_nak_seq_err", 64),
+                         ("hw_counters", "out_of_sequence", 64), ("hw_counters", "duplicate_request", 64)]
 
-class NetworkMonitor:
-    def __init__(self):
+    def __init__(self, error_counters=False):
         self.ib_phys = self._scan_ib_physical()
         self.ib_names = [x[0] for x in self.ib_phys]
         self.eth_phys = self._scan_eth_physical()
         self.eth_names = [x[0] for x in self.eth_phys]
-        
+
+        # 错误计数: 列名 IB_<dev>_port<N>_<counter>，值为每秒增量
+        self.err_cols = []
+        self.err_fds = []
+        self.err_max = []   # 定宽计数的饱和值，64 位计数为 None
+        if error_counters:
+            for name, path, _ in self.ib_phys:
+                port_dir = os.path.dirname(path)
+                for sub, cnt, bits in self.IB_ERROR_COUNTERS:
+                    try: fd = os.open(os.path.join(port_dir, sub, cnt), os.O_RDONLY)
+                    except: continue
+                    self.err_cols.append(f"IB_{name}_{cnt}")
+                    self.err_fds.append(fd)
+                    self.err_max.append((1 << bits) - 1 if bits < 64 else None)
+        self.err_header = "Timestamp," + ",".join(f"{c}_per_s" for c in self.err_cols)
+        self.last_err = self._read_errors()
+        self.last_err_time = time.monotonic()
+
+        # key -> (rx_fd, tx_fd, 位宽掩码, 单位字节数)
+        self.counters = {}
+        for name, path, (rx_n, tx_n, bits, unit) in self.ib_phys:
+            self._open_pair(f"IB_{name}", os.path.join(path, rx_n), os.path.join(path, tx_n), bits, unit)
+        for name, path in self.eth_phys:
+            self._open_pair(f"ETH_{name}", os.path.join(path, "rx_bytes"), os.path.join(path, "tx_bytes"), 64, 1)
+
         self.last_stats = self._read_counters()
-        self.last_time = time.time()
+        self.last_time = time.monotonic()
+
+    def _open_pair(self, key, rx_path, tx_path, bits, unit):
+        try:
+            rx_fd = os.open(rx_path, os.O_RDONLY)
+        except: return
+        try:
+            tx_fd = os.open(tx_path, os.O_RDONLY)
+        except:
+            os.close(rx_fd)
+            return
+        self.counters[key] = (rx_fd, tx_fd, (1 << bits) - 1, unit)
 
     def _scan_ib_physical(self):
         base = "/sys/class/infiniband"
         devices = []
         if not os.path.exists(base): return []
         
-        candidates = [("port_rcv_data_64", "port_xmit_data_64"), 
-                      ("port_rcv_data", "port_xmit_data"), 
-                      ("rx_bytes", "tx_bytes")]
         try:
             for dev in sorted(os.listdir(base)): 
                 ports_dir = os.path.join(base, dev, "ports")
@@ -92,10 +102,10 @@ class NetworkMonitor:
                     cnt_path = os.path.join(ports_dir, port, "counters")
                     if not os.path.isdir(cnt_path): continue
                     
-                    for rx, tx in candidates:
+                    for rx, tx, bits, unit in self.IB_CANDIDATES:
                         if os.path.exists(os.path.join(cnt_path, tx)):
                             name = f"{dev}_port{port}"
-                            devices.append((name, cnt_path, (rx, tx)))
+                            devices.append((name, cnt_path, (rx, tx, bits, unit)))
                             break
         except: pass
         return devices
@@ -120,182 +130,529 @@ class NetworkMonitor:
 
     def _read_counters(self):
         stats = {}
-        for name, path, (rx_n, tx_n) in self.ib_phys:
-            try:
-                r = 0; t = 0
-                with open(os.path.join(path, rx_n), 'r') as f:
-                    v = int(f.read().strip())
-                    if "packet" not in rx_n and "bytes" not in rx_n: v *= 4
-                    r = v
-                with open(os.path.join(path, tx_n), 'r') as f:
-                    v = int(f.read().strip())
-                    if "packet" not in tx_n and "bytes" not in tx_n: v *= 4
-                    t = v
-                stats[f"IB_{name}"] = {'rx': r, 'tx': t}
-            except: pass
-
-        for name, path in self.eth_phys:
+        for key, (rx_fd, tx_fd, _, _) in self.counters.items():
             try:
-                r = 0; t = 0
-                with open(os.path.join(path, "rx_bytes"), 'r') as f:
-                    r = int(f.read().strip())
-                with open(os.path.join(path, "tx_bytes"), 'r') as f:
-                    t = int(f.read().strip())
-                stats[f"ETH_{name}"] = {'rx': r, 'tx': t}
+                stats[key] = (int(os.pread(rx_fd, 32, 0)), int(os.pread(tx_fd, 32, 0)))
             except: pass
         return stats
 
     def collect(self):
+        """返回 {key: {'rx_mbps': float|None, 'tx_mbps': float|None}}"""
         curr = self._read_counters()
+        now = time.monotonic()
+        elapsed = now - self.last_time
         res = {}
-        for key, curr_val in curr.items():
-            last_val = self.last_stats.get(key, {'rx': 0, 'tx': 0})
-            dr = max(0, curr_val['rx'] - last_val['rx'])
-            dt = max(0, curr_val['tx'] - last_val['tx'])
-            res[key] = {'rx_mb': dr / 1048576.0, 'tx_mb': dt / 1048576.0}
+        if elapsed > 0:
+            for key, (r, t) in curr.items():
+                last = self.last_stats.get(key)
+                if last is None: continue
+                _, _, mask, unit = self.counters[key]
+                wraps = mask < self.MASK_64
+                rates = []
+                for c, p in ((r, last[0]), (t, last[1])):
+                    if wraps and c == mask and p == mask:
+                        rates.append(None)  # 饱和: 无法得知真实增量
+                    else:
+                        delta = c - p if c >= p else ((c - p) & mask if wraps else c)
+                        rates.append(delta * unit / 1048576.0 / elapsed)
+                res[key] = {'rx_mbps': rates[0], 'tx_mbps': rates[1]}
         self.last_stats = curr
+        self.last_time = now
         return res
 
-class HostAgent:
-    def __init__(self, root, target_name, interval):
-        try: os.nice(19)
+    def _read_errors(self):
+        vals = []
+        for fd in self.err_fds:
+            try: vals.append(int(os.pread(fd, 32, 0)))
+            except: vals.append(None)
+        return vals
+
+    def collect_errors(self):
+        """
+        返回与 err_cols 对齐的每秒增量列表；计数被清零时按新值计，不可读时为 None。
+        定宽计数停在最大值 (饱和) 时真实增量未知，同样为 None (与 collect() 对饱和数据计数的处理一致)，
+        不能按 0 计: 打满的 port_xmit_wait 恰恰意味着持续拥塞。
+        """
+        if not self.err_fds: return None
+        curr = self._read_errors()
+        now = time.monotonic()
+        elapsed = now - self.last_err_time
+        prev = self.last_err
+        self.last_err, self.last_err_time = curr, now
+        if elapsed <= 0: return None
+        res = []
+        for c, p, m in zip(curr, prev, self.err_max):
+            if c is None or p is None or (m is not None and c >= m): res.append(None)
+            else: res.append((c - p if c >= p else c) / elapsed)
+        return res
+
+    def close(self):
+        for fd in self.err_fds:
+            try: os.close(fd)
+            except: pass
+        for rx_fd, tx_fd, _, _ in self.counters.values():
+            for fd in (rx_fd, tx_fd):
+                try: os.close(fd)
+                except: pass
+
+class SystemMonitor:
+    """
+    节点级扩展指标 (--system_detail 开启):
+      - /proc/stat    -> 每核 CPU 利用率 (system_cpu.csv, 列 cpu0..cpuN，可直接画热力图)
+      - /proc/loadavg -> load1/5/15 与可运行线程数 (system_load.csv)
+      - /proc/vmstat  -> 缺页/主缺页/换入/换出速率 (system_vmstat.csv)
+      - /sys/devices/system/node/node*/meminfo -> 每 NUMA 节点已用内存 (system_numa.csv)
+    每个源只在初始化时 open 一次并定位字段所在行，之后每 tick 一次 os.pread，按行号/列号取值。
+    """
+    VMSTAT_KEYS = (b"pgfault", b"pgmajfault", b"pswpin", b"pswpout")
+
+    def __init__(self):
+        self.fds = []
+        self.stat_fd = self._open("/proc/stat")
+        self.load_fd = self._open("/proc/loadavg")
+        self.vm_fd = self._open("/proc/vmstat")
+
+        # /proc/stat: 记录 cpuN 行数及其所占字节数 (intr 等后续大行无需读取)
+        self.cpu_names = []
+        self.stat_size = 4096
+        if self.stat_fd is not None:
+            data = self._read_all(self.stat_fd)
+            lines = data.split(b'\n')
+            for line in lines[1:]:
+                if not line.startswith(b"cpu"): break
+                self.cpu_names.append(line.split(b' ', 1)[0].decode())
+            cpu_bytes = sum(len(l) + 1 for l in lines[:len(self.cpu_names) + 1])
+            self.stat_size = cpu_bytes * 2 + 4096  # 计数增长留余量
+        self.prev_cpu = None
+
+        # /proc/vmstat: 行号在同一内核下固定
+        self.vm_size = 16384
+        self.vm_idx = []
+        if self.vm_fd is not None:
+            data = self._read_all(self.vm_fd)
+            self.vm_size = len(data) * 2
+            names = [l.split(b' ', 1)[0] for l in data.split(b'\n')]
+            self.vm_idx = [names.index(k) if k in names else -1 for k in self.VMSTAT_KEYS]
+        self.prev_vm = None
+
+        # NUMA: 每个节点一个 meminfo，MemUsed 所在行号固定
+        self.numa = []  # (name, fd, line_idx)
+        base = "/sys/devices/system/node"
+        try:
+            for d in sorted(os.listdir(base), key=lambda x: int(x[4:]) if x[4:].isdigit() else -1):
+                if not (d.startswith("node") and d[4:].isdigit()): continue
+                fd = self._open(os.path.join(base, d, "meminfo"))
+                if fd is None: continue
+                lines = self._read_all(fd).split(b'\n')
+                idx = next((i for i, l in enumerate(lines) if b"MemUsed:" in l), -1)
+                if idx >= 0: self.numa.append((d, fd, idx))
         except: pass
+
+        self.cpu_header = "Timestamp," + ",".join(self.cpu_names)
+        self.load_header = "Timestamp,Load1,Load5,Load15,Runnable,Threads"
+        self.vm_header = "Timestamp,PgFault_per_s,PgMajFault_per_s,PswpIn_per_s,PswpOut_per_s"
+        self.numa_header = "Timestamp," + ",".join(f"{n}_Used_MB" for n, _, _ in self.numa)
+
+    def _open(self, path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            self.fds.append(fd)
+            return fd
+        except: return None
+
+    def _read_all(self, fd):
+        chunks = []; off = 0
+        while True:
+            b = os.pread(fd, 65536, off)
+            if not b: break
+            chunks.append(b); off += len(b)
+        return b"".join(chunks)
+
+    def collect_cpu(self):
+        """返回每核利用率列表 (%)，首个 tick 返回 None"""
+        if self.stat_fd is None or not self.cpu_names: return None
+        lines = os.pread(self.stat_fd, self.stat_size, 0).split(b'\n', len(self.cpu_names) + 1)
+        cur = []
+        for line in lines[1:len(self.cpu_names) + 1]:
+            f = line.split()
+            # user nice system idle iowait irq softirq steal
+            total = int(f[1]) + int(f[2]) + int(f[3]) + int(f[4]) + int(f[5]) + int(f[6]) + int(f[7]) + int(f[8])
+            cur.append((total, int(f[4]) + int(f[5])))
+        prev, self.prev_cpu = self.prev_cpu, cur
+        if prev is None or len(prev) != len(cur): return None
+        res = []
+        for (t1, i1), (t0, i0) in zip(cur, prev):
+            dt = t1 - t0
+            res.append(round(100.0 * (dt - (i1 - i0)) / dt, 1) if dt > 0 else 0.0)
+        return res
+
+    def collect_load(self):
+        if self.load_fd is None: return None
+        f = os.pread(self.load_fd, 128, 0).split()
+        run, threads = f[3].split(b'/')
+        return [float(f[0]), float(f[1]), float(f[2]), int(run), int(threads)]
+
+    def collect_vmstat(self):
+        """返回各计数的每秒速率，首个 tick 返回 None"""
+        if self.vm_fd is None or not self.vm_idx: return None
+        lines = os.pread(self.vm_fd, self.vm_size, 0).split(b'\n')
+        now = time.monotonic()
+        cur = [int(lines[i].split(b' ', 1)[1]) if i >= 0 else 0 for i in self.vm_idx]
+        prev, self.prev_vm = self.prev_vm, (cur, now)
+        if prev is None: return None
+        dt = now - prev[1]
+        if dt <= 0: return None
+        return [round(max(0, c - p) / dt, 1) for c, p in zip(cur, prev[0])]
+
+    def collect_numa(self):
+        res = []
+        for _, fd, idx in self.numa:
+            line = os.pread(fd, 4096, 0).split(b'\n')[idx]
+            res.append(round(int(line.split()[-2]) / 1024.0, 1))
+        return res
+
+    def close(self):
+        for fd in self.fds:
+            try: os.close(fd)
+            except: pass
+
+class ProcessTracker:
+    """
+    目标进程树跟踪器:
+    1. 发现阶段: 全量扫描 /proc，找到目标进程后记录其父进程 (mpirun/orted/hydra_pmi_proxy 等启动器) 作为根；
+    2. 跟踪阶段: 每个 tick 仅沿 /proc/<pid>/task/*/children 遍历根的子树，
+       新 fork 的进程自动加入，退出的进程自动移除，开销只与作业进程数相关；
+    3. 根全部退出后回到发现阶段；根仍存活但子树内连续 REDISCOVER_TICKS 个 tick 没有目标时
+       (如作业脚本常驻、下一步 mpirun 由别的进程拉起) 也补一次全量扫描，新根并入已有根。
+    单个 PID 的判定交给 PidMatcher (按 pid + 启动时间缓存)，统一 Agent 中与 GPU 插件共用同一实例。
+    内核未开启 CONFIG_PROC_CHILDREN (无 children 文件) 时退化为每 tick 全量扫描。
+    """
+    REDISCOVER_TICKS = 10
+
+    def __init__(self, target_name, matcher=None):
         self.target_name = target_name
-        self.interval = max(0.1, interval)
-        self.node = socket.gethostname()
-        self.writer = AsyncWriter(root, self.node)
-        self.prev_cpu = {}
-        try: self.clk_tck = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
-        except: self.clk_tck = 100
-        
-        self.net_mon = NetworkMonitor()
-        
-        self.col_keys = []
-        for name in self.net_mon.ib_names: self.col_keys.append(f"IB_{name}")
-        for name in self.net_mon.eth_names: self.col_keys.append(f"ETH_{name}")
-            
-        self.net_header = "Timestamp"
-        for key in self.col_keys: self.net_header += f",{key}_Rx_MB,{key}_Tx_MB"
+        self.matcher = matcher or PidMatcher(target_name)
+        self.my_pid = os.getpid()
+        self.roots = set()
+        self.targets = set()
+        self.idle_ticks = 0
+        self.children_supported = os.path.exists(f"/proc/{self.my_pid}/task/{self.my_pid}/children")
 
-        print(f"[HostAgent] 启动成功: Node={self.node}")
-        print(f"[HostAgent] 物理层监控列: {self.col_keys}")
+    def _read_ppid(self, pid):
+        try:
+            with open(f"/proc/{pid}/stat", 'rb') as f:
+                return int(f.read().rsplit(b')', 1)[1].split()[1])
+        except: return 0
 
-    # === [关键修复] 重新实现 _get_pids 以精准过滤 ===
-    def _get_pids(self):
-        pids = []
-        target_token = f"/{self.target_name}/"
-        my_pid = os.getpid()
-        
-        # 黑名单: 排除启动器、Shell、以及 Agent 自身
-        # 在这里显式加入 dmx_host_agent 和 dmx_device_agent
-        BLACKLIST = {
-            "mpirun", "mpiexec", "orterun", "hydra_pmi_proxy", "srun", 
-            "bash", "sh", "zsh", "csh", "tcsh",                        
-            "ssh", "sshd", "sudo", "su",
-            "dmxperf", "dmx_host_agent", "dmx_device_agent" # <--- 核心修复
-        }
+    def _children(self, pid):
+        kids = []
+        try:
+            for tid in os.listdir(f"/proc/{pid}/task"):
+                try:
+                    with open(f"/proc/{pid}/task/{tid}/children", 'rb') as f:
+                        kids.extend(int(x) for x in f.read().split())
+                except: continue
+        except: pass
+        return kids
 
+    def _full_scan(self):
+        pids = []
         try:
             for pid_str in os.listdir('/proc'):
                 if not pid_str.isdigit(): continue
                 pid = int(pid_str)
-                if pid == my_pid: continue
-                
-                try:
-                    with open(f"/proc/{pid}/cmdline", 'rb') as f:
-                        content = f.read()
-                        if not content: continue
-                        args = content.split(b'\0')
-                        
-                        exe_path = args[0].decode(errors='ignore')
-                        exe_name = os.path.basename(exe_path)
-                        full_cmd = b" ".join(args).decode(errors='ignore')
-
-                    # 1. 黑名单过滤 (现在包含了 dmx_host_agent)
-                    if exe_name in BLACKLIST: continue
-                    
-                    # 2. 额外防护: 命令行包含自身名字的也不要
-                    if "dmxperf" in full_cmd or "dmx_host_agent" in full_cmd or "dmx_device_agent" in full_cmd: 
-                        continue
-
-                    # 3. 目标匹配逻辑
-                    is_target = False
-                    if target_token in exe_path:
-                        is_target = True
-                    elif exe_path.startswith(f"./{self.target_name}"):
-                        is_target = True
-                    elif ("python" in exe_name or "python3" in exe_name) and target_token in full_cmd:
-                        is_target = True
-                    
-                    if is_target:
-                        pids.append(pid)
-
-                except: continue
+                if pid == self.my_pid: continue
+                if self.matcher.match(pid): pids.append(pid)
         except: pass
         return pids
 
-    def _collect_proc(self, pid):
-        rss = 0; cpu = 0.0
+    def _discover(self):
+        pids = self._full_scan()
+        if pids and self.children_supported:
+            for pid in pids:
+                ppid = self._read_ppid(pid)
+                # 父进程为 init/systemd 时 (daemon 化)，直接以目标自身为根，避免遍历整棵进程树
+                self.roots.add(ppid if ppid > 1 else pid)
+            self.targets = set(pids)
+        return pids
+
+    def _walk(self):
+        alive_roots = {r for r in self.roots if os.path.exists(f"/proc/{r}")}
+        if not alive_roots:
+            self.roots.clear()
+            self.matcher.forget(self.targets)
+            self.targets.clear()
+            return None
+
+        self.roots = alive_roots
+        seen = set()
+        stack = list(alive_roots)
+        while stack:
+            pid = stack.pop()
+            if pid in seen: continue
+            seen.add(pid)
+            stack.extend(self._children(pid))
+
+        # 已确认的目标命中 PidMatcher 缓存 (启动时间不变即不再读 cmdline)；
+        # 非目标进程可能尚未 exec (fork 后 cmdline 仍是启动器)，每 tick 重新判定 (数量仅限作业子树)
+        targets = {p for p in seen if self.matcher.match(p)}
+        self.matcher.forget(self.targets - targets)
+        self.targets = targets
+        return list(self.targets)
+
+    def get_pids(self):
+        if self.roots:
+            pids = self._walk()
+            if pids:
+                self.idle_ticks = 0
+                return pids
+            if pids is not None:
+                self.idle_ticks += 1
+                if self.idle_ticks < self.REDISCOVER_TICKS: return pids
+        self.idle_ticks = 0
+        return self._discover()
+
+class ProcSampler:
+    """
+    常驻描述符的 /proc 采样器:
+    每个 PID 的 stat / statm 只 open 一次，之后每 tick 用 os.pread 从偏移 0 重读；
+    RSS 取自 statm 第 2 列 (页数)，CPU 取自 stat 中 ')' 之后固定位置的 utime/stime。
+    进程退出后 pread 报 ESRCH 或读到空内容，此时关闭描述符并丢弃状态 (PID 复用时会重新打开)。
+
+    detail=True 时额外常驻 /proc/<pid>/io 与 /proc/<pid>/status，计算每秒速率:
+    磁盘读/写 (read_bytes/write_bytes)、自愿/非自愿上下文切换、次/主缺页 (stat 的 minflt/majflt)。
+    """
+    READ_SIZE = 1024
+    DETAIL_HEADER = "Timestamp,IoRead_KBps,IoWrite_KBps,CtxVol_per_s,CtxNonvol_per_s,MinFlt_per_s,MajFlt_per_s"
+
+    def __init__(self, detail=False):
+        self.detail = detail
+        self.fds = {}       # pid -> [stat_fd, statm_fd, io_fd, status_fd]
+        self.prev = {}      # pid -> (monotonic, ticks, counters)
+        self.ctx_idx = None # status 中 voluntary/nonvoluntary_ctxt_switches 所在行号
+        try: self.clk_tck = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+        except: self.clk_tck = 100
+        try: self.page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+        except: self.page_kb = 4
+
+    def _open(self, pid):
+        fds = self.fds.get(pid)
+        if fds is None:
+            fds = []
+            try:
+                fds.append(os.open(f"/proc/{pid}/stat", os.O_RDONLY))
+                fds.append(os.open(f"/proc/{pid}/statm", os.O_RDONLY))
+                if self.detail:
+                    # io 需要同用户/ptrace 权限，内核未开启任务 IO 统计时不存在；打不开时仅缺失该项，
+                    # CPU/RSS 照常采样 (进程已退出时下面打开 status 失败，整体丢弃)
+                    try: fds.append(os.open(f"/proc/{pid}/io", os.O_RDONLY))
+                    except OSError: fds.append(None)
+                    fds.append(os.open(f"/proc/{pid}/status", os.O_RDONLY))
+            except:
+                for fd in fds:
+                    if fd is not None: os.close(fd)
+                raise
+            self.fds[pid] = fds
+        return fds
+
+    def _drop(self, pid):
+        fds = self.fds.pop(pid, None)
+        self.prev.pop(pid, None)
+        if fds:
+            for fd in fds:
+                if fd is None: continue
+                try: os.close(fd)
+                except: pass
+
+    def _read_counters(self, fds, stat_parts):
+        """返回 (read_bytes, write_bytes, ctx_vol, ctx_nonvol, minflt, majflt)"""
+        rd = wr = 0
+        if fds[2] is not None:
+            # rchar wchar syscr syscw read_bytes write_bytes ...
+            io = os.pread(fds[2], 512, 0).split(b'\n')
+            rd = int(io[4].split()[1]); wr = int(io[5].split()[1])
+        status = os.pread(fds[3], 4096, 0).split(b'\n')
+        if self.ctx_idx is None:
+            names = [l.split(b':', 1)[0] for l in status]
+            self.ctx_idx = (names.index(b"voluntary_ctxt_switches"), names.index(b"nonvoluntary_ctxt_switches"))
+        vol = int(status[self.ctx_idx[0]].split()[1])
+        nonvol = int(status[self.ctx_idx[1]].split()[1])
+        return (rd, wr, vol, nonvol, int(stat_parts[7]), int(stat_parts[9]))
+
+    def sample(self, pid):
+        """
+        返回 (cpu%, rss_kb, detail)；detail 为与 DETAIL_HEADER 对齐的速率列表，
+        未开启 detail 或首个 tick 时为 None。进程已退出时返回 (0.0, 0, None)。
+        """
         try:
-            with open(f"/proc/{pid}/status") as f:
-                for line in f:
-                    if line.startswith("VmRSS:"): rss = int(line.split()[1]); break
-            with open(f"/proc/{pid}/stat") as f:
-                parts = f.read().split(')')[-1].split()
-                ticks = int(parts[11]) + int(parts[12])
-            now = time.time()
-            if pid in self.prev_cpu:
-                pt, ptm = self.prev_cpu[pid]
-                dt = now - ptm
-                if dt > 0: cpu = ((ticks - pt) / self.clk_tck) / dt * 100
-            self.prev_cpu[pid] = (ticks, now)
+            fds = self._open(pid)
+            stat = os.pread(fds[0], self.READ_SIZE, 0)
+            statm = os.pread(fds[1], 128, 0)
+            if not stat or not statm: raise ProcessLookupError(pid)
+            # comm 字段可能含空格/括号，以最后一个 ')' 为锚点；其后第 7/9 列为 minflt/majflt，第 11/12 列为 utime/stime
+            parts = stat[stat.rindex(b')') + 2:].split(b' ', 13)
+            counters = self._read_counters(fds, parts) if self.detail else None
+        except OSError:
+            self._drop(pid)
+            return 0.0, 0, None
+
+        ticks = int(parts[11]) + int(parts[12])
+        rss = int(statm.split(b' ', 2)[1]) * self.page_kb
+
+        cpu = 0.0
+        detail = None
+        now = time.monotonic()
+        prev = self.prev.get(pid)
+        if prev:
+            dt = now - prev[0]
+            if dt > 0:
+                cpu = ((ticks - prev[1]) / self.clk_tck) / dt * 100
+                if counters and prev[2]:
+                    d = [max(0, c - p) / dt for c, p in zip(counters, prev[2])]
+                    detail = [round(d[0] / 1024.0, 1), round(d[1] / 1024.0, 1)] + [round(x, 1) for x in d[2:]]
+        self.prev[pid] = (now, ticks, counters)
+        return round(cpu, 1), rss, detail
+
+    def prune(self, active_pids):
+        """关闭不再跟踪的 PID 的描述符"""
+        active = set(active_pids)
+        for pid in [p for p in self.fds if p not in active]:
+            self._drop(pid)
+
+    def close(self):
+        for pid in list(self.fds):
+            self._drop(pid)
+
+# ==============================================================================
+# 采集插件 (统一 Agent 也装载这些插件)
+# ==============================================================================
+class SystemCollector(Collector):
+    """节点内存占用；--system_detail 时追加每核 CPU / 负载 / vmstat / NUMA"""
+    name = "system"
+    stages = ("sys_read",)
+
+    def __init__(self, system_detail=False):
+        self.sys_mon = SystemMonitor() if system_detail else None
+
+    def collect(self, ctx):
+        try:
+            with open('/proc/meminfo') as f: mem = {l.split(':')[0]: int(l.split()[1]) for l in f}
+            sys_mem = (mem['MemTotal'] - mem.get('MemAvailable', mem['MemFree'])) / 1024
+            ctx.writer.write("", "system_memory.csv", ctx.ts, f"{sys_mem:.1f}")
         except: pass
-        return round(cpu, 1), rss
 
-    def run(self):
+        sm = self.sys_mon
+        if not sm: return
+        for fn, name, header in ((sm.collect_cpu, "system_cpu.csv", sm.cpu_header),
+                                 (sm.collect_load, "system_load.csv", sm.load_header),
+                                 (sm.collect_vmstat, "system_vmstat.csv", sm.vm_header),
+                                 (sm.collect_numa, "system_numa.csv", sm.numa_header)):
+            try:
+                vals = fn()
+                if vals: ctx.writer.write("", name, ctx.ts, ",".join(str(v) for v in vals), header=header)
+            except: pass
+
+    def close(self):
+        if self.sys_mon: self.sys_mon.close()
+
+class NetworkCollector(Collector):
+    """物理 IB/以太网卡速率 (network_metrics.csv)；--ib_errors 时追加 network_errors.csv"""
+    name = "network"
+    stages = ("net_read",)
+
+    def __init__(self, ib_errors=False):
+        self.net_mon = NetworkMonitor(error_counters=ib_errors)
+        self.col_keys = [f"IB_{n}" for n in self.net_mon.ib_names] + [f"ETH_{n}" for n in self.net_mon.eth_names]
+        self.net_header = "Timestamp" + "".join(f",{k}_Rx_MBps,{k}_Tx_MBps" for k in self.col_keys)
+
+    def collect(self, ctx):
         try:
-            print("[HostAgent] 进入监控循环...")
-            time.sleep(self.interval)
-            
-            while running:
-                ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            net_data = self.net_mon.collect()
+            val_list = []
+            for key in self.col_keys:
+                d = net_data.get(key, {'rx_mbps': None, 'tx_mbps': None})
+                for v in (d['rx_mbps'], d['tx_mbps']):
+                    val_list.append("" if v is None else f"{v:.4f}")
+            ctx.writer.write("", "network_metrics.csv", ctx.ts, ",".join(val_list), header=self.net_header)
+        except: pass
 
-                try:
-                    with open('/proc/meminfo') as f: mem = {l.split(':')[0]: int(l.split()[1]) for l in f}
-                    sys_mem = (mem['MemTotal'] - mem.get('MemAvailable', mem['MemFree'])) / 1024
-                    self.writer.write("", "system_memory.csv", ts, f"{sys_mem:.1f}")
-                except: pass
+        try:
+            errs = self.net_mon.collect_errors()
+            if errs:
+                vals = ",".join("" if v is None else f"{v:.1f}" for v in errs)
+                ctx.writer.write("", "network_errors.csv", ctx.ts, vals, header=self.net_mon.err_header)
+        except: pass
 
-                try:
-                    net_data = self.net_mon.collect()
-                    val_list = []
-                    for key in self.col_keys:
-                        d = net_data.get(key, {'rx_mb':0.0, 'tx_mb':0.0})
-                        val_list.append(f"{d['rx_mb']:.4f}")
-                        val_list.append(f"{d['tx_mb']:.4f}")
-                    self.writer.write("", "network_metrics.csv", ts, ",".join(val_list), header=self.net_header)
-                except: pass
+    def close(self):
+        self.net_mon.close()
 
-                for pid in self._get_pids():
-                    c, r = self._collect_proc(pid)
-                    self.writer.write(pid, "proc_cpu_util.csv", ts, c)
-                    self.writer.write(pid, "proc_mem_rss.csv", ts, r)
+class ProcCollector(Collector):
+    """目标进程 CPU / RSS；--proc_detail 时追加 IO / 上下文切换 / 缺页速率"""
+    name = "proc"
+    stages = ("proc_read",)
+    needs_pids = True
 
-                time.sleep(self.interval)
-                
-        except Exception as e:
-            print(f"❌ Error: {e}")
-        finally:
-            self.writer.close()
+    def __init__(self, proc_detail=False):
+        self.sampler = ProcSampler(detail=proc_detail)
+
+    def collect(self, ctx):
+        pids = ctx.pids
+        self.sampler.prune(pids)
+        for pid in pids:
+            c, r, detail = self.sampler.sample(pid)
+            ctx.writer.write(pid, "proc_cpu_util.csv", ctx.ts, c)
+            ctx.writer.write(pid, "proc_mem_rss.csv", ctx.ts, r)
+            if detail:
+                ctx.writer.write(pid, "proc_detail.csv", ctx.ts, ",".join(str(v) for v in detail),
+                                 header=ProcSampler.DETAIL_HEADER)
+
+    def close(self):
+        self.sampler.close()
+
+class HostAgent:
+    def __init__(self, root, target_name, interval, flush_interval=5.0, flush_bytes=65536, layout="wide",
+                 system_detail=False, ib_errors=False, proc_detail=False, max_queue=50000, queue_policy="spill",
+                 state_dir=None):
+        try: os.nice(19)
+        except: pass
+        self.target_name = target_name
+        self.interval = max(0.01, interval)
+        self.node = socket.gethostname()
+        self.writer = AsyncWriter(root, self.node, flush_interval, flush_bytes, layout, "host",
+                                  max_queue, queue_policy, state_dir=state_dir)
+        self.tracker = ProcessTracker(target_name)
+        self.net = NetworkCollector(ib_errors)
+        self.collectors = [SystemCollector(system_detail), self.net, ProcCollector(proc_detail)]
+
+        print(f"[HostAgent] 启动成功: Node={self.node}")
+        print(f"[HostAgent] 物理层监控列: {self.net.col_keys}")
+
+    def run(self):
+        CollectorLoop("HostAgent", self.writer, self.collectors, self.interval,
+                      "agent_stats_host.csv", tracker=self.tracker).run(lambda: running)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--timeseries_root", required=True)
     parser.add_argument("--target_name", required=True)
     parser.add_argument("--interval", type=float, default=1.0)
+    parser.add_argument("--flush_interval", type=float, default=5.0, help="缓存最长停留秒数, <=0 为逐行写出")
+    parser.add_argument("--flush_bytes", type=int, default=65536, help="单文件缓存达到该字节数即写出")
+    parser.add_argument("--layout", choices=["wide", "long"], default="wide", help="long: 进程数据写入单个 host_samples.csv")
+    parser.add_argument("--system_detail", action="store_true", help="采集每核 CPU / 负载 / vmstat / NUMA 内存")
+    parser.add_argument("--ib_errors", action="store_true", help="采集 IB 拥塞/错误/重传计数到 network_errors.csv")
+    parser.add_argument("--proc_detail", action="store_true", help="采集进程 IO / 上下文切换 / 缺页速率到 proc_detail.csv")
+    parser.add_argument("--max_queue", type=int, default=50000, help="写队列上限 (条)")
+    parser.add_argument("--queue_policy", choices=["block", "drop_oldest", "spill"], default="spill",
+                        help="写队列满时: 阻塞采样 / 丢弃最旧 / 溢出到本地文件")
+    parser.add_argument("--state_dir", default=None, help="本次运行的状态目录 (PID 登记与 ready/done 标记)")
     args = parser.parse_args()
+    register_agent(args.timeseries_root, args.state_dir, "host")
     
     signal.signal(signal.SIGTERM, handle_signal)
     signal.signal(signal.SIGINT, handle_signal)
     
-    HostAgent(args.timeseries_root, args.target_name, args.interval).run()
\ No newline at end of file
+    HostAgent(args.timeseries_root, args.target_name, args.interval,
+              flush_interval=args.flush_interval, flush_bytes=args.flush_bytes, layout=args.layout,
+              system_detail=args.system_detail, ib_errors=args.ib_errors, proc_detail=args.proc_detail,
+              max_queue=args.max_queue, queue_policy=args.queue_policy, state_dir=args.state_dir).run()
\ No newline at end of file
@@ -0,0 +1,103 @@
+# dmxperf/agents/unified_agent.py
+# -*- coding: utf-8 -*-
+"""
+统一 Agent: 单进程内装载 Host / Network / GPU 采集插件，共享一个调度器、一个写线程，
+目标 PID 每 tick 只发现一次。命令行参数为 host_agent 与 device_agent 参数的并集。
+"""
+import argparse
+import importlib
+import os
+import signal
+import socket
+
+try:
+    from dmxperf.agents.agent_common import AsyncWriter, CollectorLoop, register_agent
+    from dmxperf.agents.host_agent import ProcessTracker, SystemCollector, NetworkCollector, ProcCollector
+    from dmxperf.agents.device_agent import GpuCollector, resolve_nvml_timeout
+except ImportError:
+    from agent_common import AsyncWriter, CollectorLoop, register_agent
+    from host_agent import ProcessTracker, SystemCollector, NetworkCollector, ProcCollector
+    from device_agent import GpuCollector, resolve_nvml_timeout
+
+running = True
+def handle_signal(s, f):
+    global running
+    try:
+        print(f"[Agent] 收到信号 {s}，准备退出...")
+    except: pass
+    running = False
+
+# 内置插件: 名字 -> 由命令行参数构造插件
+COLLECTORS = {
+    "system":  lambda args: SystemCollector(args.system_detail),
+    "network": lambda args: NetworkCollector(args.ib_errors),
+    "proc":    lambda args: ProcCollector(args.proc_detail),
+    "gpu":     lambda args: GpuCollector(args.target_name, detail=args.gpu_detail,
+                                         nvml_timeout=resolve_nvml_timeout(args.nvml_timeout, max(0.01, args.interval))),
+}
+DEFAULT_COLLECTORS = "system,network,proc,gpu"
+
+def load_collector(spec, args):
+    """spec 为内置插件名，或 "包.模块:类名" 形式的外部插件 (类以 args 为唯一参数构造)"""
+    if spec in COLLECTORS:
+        return COLLECTORS[spec](args)
+    if ":" not in spec:
+        raise ValueError(f"未知采集插件: {spec} (可选: {', '.join(COLLECTORS)} 或 module:Class)")
+    mod_name, cls_name = spec.split(":", 1)
+    return getattr(importlib.import_module(mod_name), cls_name)(args)
+
+class UnifiedAgent:
+    def __init__(self, args):
+        try: os.nice(19)
+        except: pass
+        self.interval = max(0.01, args.interval)
+        self.node = socket.gethostname()
+        self.writer = AsyncWriter(args.timeseries_root, self.node, args.flush_interval, args.flush_bytes,
+                                  args.layout, "agent", args.max_queue, args.queue_policy, state_dir=args.state_dir)
+        self.collectors = []
+        try:
+            for spec in [s.strip() for s in args.collectors.split(",") if s.strip()]:
+                self.collectors.append(load_collector(spec, args))
+        except Exception:
+            for c in self.collectors: c.close()
+            self.writer.close()
+            raise
+        self.tracker = ProcessTracker(args.target_name) if any(c.needs_pids for c in self.collectors) else None
+        print(f"[Agent] 启动成功: Node={self.node}, 目标: '{args.target_name}'")
+
+    def run(self):
+        CollectorLoop("Agent", self.writer, self.collectors, self.interval,
+                      "agent_stats.csv", tracker=self.tracker).run(lambda: running)
+
+def main(argv=None):
+    """命令行入口 (zipapp 打包时的入口点为 unified_agent:main)"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--timeseries_root", required=True)
+    parser.add_argument("--target_name", required=True)
+    parser.add_argument("--interval", type=float, default=1.0)
+    parser.add_argument("--collectors", default=DEFAULT_COLLECTORS,
+                        help=f"逗号分隔的采集插件 ({', '.join(COLLECTORS)} 或 module:Class)")
+    parser.add_argument("--gpus_per_proc", type=int, default=1)
+    parser.add_argument("--gpu_detail", action="store_true", help="采集时钟/温度/降频原因/PCIe/NVLink 吞吐")
+    parser.add_argument("--nvml_timeout", type=float, default=0.0,
+                        help="单卡 NVML 采样截止时间 (秒); 0 为采样间隔的一半, <0 关闭看门狗")
+    parser.add_argument("--flush_interval", type=float, default=5.0, help="缓存最长停留秒数, <=0 为逐行写出")
+    parser.add_argument("--flush_bytes", type=int, default=65536, help="单文件缓存达到该字节数即写出")
+    parser.add_argument("--layout", choices=["wide", "long"], default="wide", help="long: 进程数据写入单个 agent_samples.csv")
+    parser.add_argument("--system_detail", action="store_true", help="采集每核 CPU / 负载 / vmstat / NUMA 内存")
+    parser.add_argument("--ib_errors", action="store_true", help="采集 IB 拥塞/错误/重传计数到 network_errors.csv")
+    parser.add_argument("--proc_detail", action="store_true", help="采集进程 IO / 上下文切换 / 缺页速率到 proc_detail.csv")
+    parser.add_argument("--max_queue", type=int, default=50000, help="写队列上限 (条)")
+    parser.add_argument("--queue_policy", choices=["block", "drop_oldest", "spill"], default="spill",
+                        help="写队列满时: 阻塞采样 / 丢弃最旧 / 溢出到本地文件")
+    parser.add_argument("--state_dir", default=None, help="本次运行的状态目录 (PID 登记与 ready/done 标记)")
+    args = parser.parse_args(argv)
+    register_agent(args.timeseries_root, args.state_dir, "agent")
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    UnifiedAgent(args).run()
+
+if __name__ == "__main__":
+    main()
@@ -3,19 +3,27 @@
 import os
 import glob
 import pandas as pd
+from dmxperf.analysis.time import parse_timestamps
 import numpy as np
 import matplotlib
 matplotlib.use('Agg') # 后台绘图
 import matplotlib.pyplot as plt
 
 class NetworkPlotter:
+    # port_xmit_wait 计数单位为 tick；ConnectX 系列 HCA 一个 tick 为 4ns (250 MHz)，其他硬件可由配置覆盖
+    XMIT_WAIT_TICK_NS = 4.0
+
     def __init__(self, run_root):
         self.run_root = run_root
         self.metrics_root = os.path.join(run_root, "metrics")
 
-    def plot_cluster_network(self, job_name):
+    def plot_cluster_network(self, job_name, xmit_wait_threshold=0.05, xmit_wait_tick_ns=None):
         """
         入口函数：绘制集群维度的网络分析图
+        xmit_wait_threshold: 拥塞判定阈值，单位为"端口有数据待发却发不出的时间占比" (0~1，默认 5%)；
+            占比 = port_xmit_wait 每秒增量 (tick/s) x tick 时长，任一端口超过阈值的区间在图中标记为拥塞
+        xmit_wait_tick_ns: 一个 xmit_wait tick 的纳秒数，默认 XMIT_WAIT_TICK_NS
+        (需 Agent 开启 ib_errors 采集 network_errors.csv)
         """
         job_dir = os.path.join(self.metrics_root, job_name)
         ts_dir = os.path.join(job_dir, "TimeSeries")
@@ -37,18 +45,50 @@ class NetworkPlotter:
             df['RelativeTime'] = (df['Timestamp'] - global_min_time).dt.total_seconds()
             valid_dfs[node] = df
 
+        # 2.1 拥塞区间 (port_xmit_wait 超阈值)
+        err_dfs, _ = self._load_all_nodes(ts_dir, "network_errors.csv")
+        congestion = {}
+        for node, df in err_dfs.items():
+            df['RelativeTime'] = (df['Timestamp'] - global_min_time).dt.total_seconds()
+            congestion[node] = self._congested_spans(df, xmit_wait_threshold,
+                                                     float(xmit_wait_tick_ns or self.XMIT_WAIT_TICK_NS))
+
         # 3. 加载事件时间 (严格对齐 reporter.py 逻辑)
         events = self._load_events(events_dir, global_min_time)
 
         # === 4. 生成图表 ===
         # [核心图] 分节点堆叠子图 (6条线: IB/ENS/IBP 的 Rx/Tx)
-        self._plot_per_node_subplots(valid_dfs, events, plots_dir)
+        self._plot_per_node_subplots(valid_dfs, events, plots_dir, congestion,
+                                     f"xmit_wait > {xmit_wait_threshold:.0%}")
 
-    def _load_all_nodes(self, ts_dir):
+    def _congested_spans(self, df, threshold, tick_ns):
+        """
+        返回任一端口发送等待时间占比 > threshold 的 [(start, end), ...] (相对秒)。
+        Agent 在 32 位 port_xmit_wait 打满 (停在最大值) 时写空值，此类样本同样视为拥塞。
+        """
+        cols = [c for c in df.columns if 'port_xmit_wait' in c]
+        if not cols or df.empty: return []
+        d = df.sort_values('RelativeTime')
+        stalled = d[cols].apply(pd.to_numeric, errors='coerce') * (tick_ns / 1e9)
+        over = ((stalled > threshold) | stalled.isna()).any(axis=1).values
+        t = d['RelativeTime'].values
+        spans = []
+        start = None
+        for i in range(len(t)):
+            # 第 i 个样本代表 (t[i-1], t[i]] 这段间隔
+            if over[i] and start is None:
+                start = t[i - 1] if i > 0 else t[i]
+            elif not over[i] and start is not None:
+                spans.append((start, t[i - 1]))
+                start = None
+        if start is not None: spans.append((start, t[-1]))
+        return spans
+
+    def _load_all_nodes(self, ts_dir, filename="network_metrics.csv"):
         """扫描并加载 CSV"""
         node_map = {}
         min_ts = None
-        files = glob.glob(os.path.join(ts_dir, "**", "network_metrics.csv"), recursive=True)
+        files = glob.glob(os.path.join(ts_dir, "**", filename), recursive=True)
         
         for f in files:
             try:
@@ -59,7 +99,7 @@ class NetworkPlotter:
                 
                 df = pd.read_csv(f)
                 if 'Timestamp' not in df.columns: continue
-                df['Timestamp'] = pd.to_datetime(df['Timestamp'])
+                df['Timestamp'] = parse_timestamps(df['Timestamp'])
                 
                 local_min = df['Timestamp'].min()
                 if min_ts is None or local_min < min_ts:
@@ -117,7 +157,7 @@ class NetworkPlotter:
     # =========================================================
     #  图表逻辑：多子图垂直堆叠 (含 IB, ENS, IBP)
     # =========================================================
-    def _plot_per_node_subplots(self, node_dfs, events, out_dir):
+    def _plot_per_node_subplots(self, node_dfs, events, out_dir, congestion=None, congestion_label="xmit_wait"):
         nodes = sorted(node_dfs.keys())
         n_nodes = len(nodes)
         
@@ -146,7 +186,7 @@ class NetworkPlotter:
                 # 重采样
                 d = df.set_index('RelativeTime')
                 d.index = pd.to_timedelta(d.index, unit='s')
-                resampled = d.resample('1S').mean(numeric_only=True)
+                resampled = d.resample('1s').mean(numeric_only=True)
                 
                 x_axis = resampled.index.total_seconds()
 
@@ -206,6 +246,11 @@ class NetworkPlotter:
             ax.set_ylabel("MB/s", fontsize=10)
             ax.grid(True, linestyle='--', alpha=0.5)
             
+            # 拥塞区间阴影
+            for k, (t0, t1) in enumerate((congestion or {}).get(node, [])):
+                ax.axvspan(t0, t1, color='red', alpha=0.12, label=congestion_label if k == 0 else None)
+                has_data = True
+
             # 阶段竖线
             for name, time_sec in events.items():
                 c = colors_evt.get(name, 'black')
@@ -3,6 +3,7 @@ import os
 import glob
 import re
 import pandas as pd
+from dmxperf.analysis.time import parse_timestamps
 import matplotlib
 matplotlib.use('Agg') # 后台绘图
 import matplotlib.pyplot as plt
@@ -17,7 +18,7 @@ class Plotter:
     def plot_job(self, job_name, visualize_keys):
         """
         job_name: 任务名
-        visualize_keys: 需要绘制的指标列表，例如 ["cpu", "memory", "gpu_util", "power"]
+        visualize_keys: 需要绘制的指标列表，例如 ["cpu", "memory", "gpu_util", "power", "cpu_cores", "gpu_devices"]
         """
         if not visualize_keys:
             return
@@ -29,6 +30,24 @@ class Plotter:
         plots_dir = os.path.join(job_dir, "Plots")
         os.makedirs(plots_dir, exist_ok=True)
 
+        # 0. 节点级每核 CPU 热力图 (需 Agent 开启 system_detail)
+        if "cpu_cores" in [k.lower() for k in visualize_keys]:
+            for node_dir in sorted(glob.glob(os.path.join(timeseries_dir, "*"))):
+                cpu_csv = os.path.join(node_dir, "system_cpu.csv")
+                if os.path.exists(cpu_csv):
+                    self._plot_core_heatmap(os.path.basename(node_dir), cpu_csv, plots_dir)
+            visualize_keys = [k for k in visualize_keys if k.lower() != "cpu_cores"]
+
+        # 0.1 节点级每卡利用率热力图 (覆盖所有卡，不依赖进程匹配)
+        if "gpu_devices" in [k.lower() for k in visualize_keys]:
+            for node_dir in sorted(glob.glob(os.path.join(timeseries_dir, "*"))):
+                dev_csv = os.path.join(node_dir, "gpu_devices.csv")
+                if os.path.exists(dev_csv):
+                    self._plot_gpu_devices(os.path.basename(node_dir), dev_csv, plots_dir)
+            visualize_keys = [k for k in visualize_keys if k.lower() != "gpu_devices"]
+        if not visualize_keys:
+            return
+
         # 1. 扫描所有 CSV 并按节点分组
         node_files_map = defaultdict(list)
         csv_files = glob.glob(os.path.join(timeseries_dir, "**", "*_metrics.csv"), recursive=True)
@@ -56,6 +75,68 @@ class Plotter:
             for key in visualize_keys:
                 self._plot_node_metric(node, files, key, plots_dir)
 
+    def _plot_core_heatmap(self, node_name, csv_file, output_dir):
+        """
+        绘制单节点每核 CPU 利用率热力图 (纵轴: 核, 横轴: 时间)
+        """
+        try:
+            df = pd.read_csv(csv_file)
+            if 'Timestamp' not in df.columns or df.empty: return
+            df['Timestamp'] = parse_timestamps(df['Timestamp'])
+            rel = (df['Timestamp'] - df['Timestamp'].min()).dt.total_seconds()
+            core_cols = [c for c in df.columns if re.match(r'cpu\d+$', c)]
+            if not core_cols: return
+            core_cols.sort(key=lambda c: int(c[3:]))
+            data = df[core_cols].apply(pd.to_numeric, errors='coerce').fillna(0).T.values
+
+            plt.figure(figsize=(14, max(4, min(len(core_cols) * 0.05, 20))))
+            plt.imshow(data, aspect='auto', origin='lower', cmap='viridis', vmin=0, vmax=100,
+                       extent=[rel.iloc[0], rel.iloc[-1], -0.5, len(core_cols) - 0.5], interpolation='nearest')
+            plt.colorbar(label="CPU Utilization (%)")
+            plt.xlabel("Time (seconds)", fontsize=12)
+            plt.ylabel("Core", fontsize=12)
+            plt.title(f"{node_name} - Per-Core CPU", fontsize=14, fontweight='bold')
+            plt.tight_layout()
+            plt.savefig(os.path.join(output_dir, f"{node_name}_cpu_cores.png"), dpi=150)
+        except Exception as e:
+            print(f"⚠️ 绘制每核热力图失败 ({node_name}): {e}")
+        finally:
+            plt.close()
+
+    def _plot_gpu_devices(self, node_name, csv_file, output_dir):
+        """
+        绘制单节点每卡 GPU 利用率热力图 (纵轴: 卡, 横轴: 时间)，
+        并提示全程利用率为 0 的卡 (常见于 hardware_device_id_list 配置错误)
+        """
+        try:
+            df = pd.read_csv(csv_file)
+            if 'Timestamp' not in df.columns or df.empty: return
+            df['Timestamp'] = parse_timestamps(df['Timestamp'])
+            df['Util(%)'] = pd.to_numeric(df['Util(%)'], errors='coerce')
+            df['Label'] = "GPU" + df['GPU'].astype(str) + " (" + df['BusId'].astype(str) + ")"
+            wide = df.pivot_table(index='Timestamp', columns='Label', values='Util(%)', aggfunc='last').sort_index()
+            order = df.drop_duplicates('Label').sort_values('GPU')['Label'].tolist()
+            wide = wide[[c for c in order if c in wide.columns]]
+
+            idle = [c for c in wide.columns if wide[c].fillna(0).max() <= 0]
+            if idle and len(idle) < len(wide.columns):
+                print(f"      ⚠️ [Plotter] {node_name}: {idle} 全程空闲，请检查 hardware_device_id_list")
+
+            rel = (wide.index - wide.index.min()).total_seconds()
+            plt.figure(figsize=(14, max(3, len(wide.columns) * 0.5)))
+            plt.imshow(wide.fillna(0).T.values, aspect='auto', origin='lower', cmap='viridis', vmin=0, vmax=100,
+                       extent=[rel[0], rel[-1], -0.5, len(wide.columns) - 0.5], interpolation='nearest')
+            plt.colorbar(label="GPU Utilization (%)")
+            plt.yticks(range(len(wide.columns)), wide.columns, fontsize=8)
+            plt.xlabel("Time (seconds)", fontsize=12)
+            plt.title(f"{node_name} - Per-Device GPU", fontsize=14, fontweight='bold')
+            plt.tight_layout()
+            plt.savefig(os.path.join(output_dir, f"{node_name}_gpu_devices.png"), dpi=150)
+        except Exception as e:
+            print(f"⚠️ 绘制每卡热力图失败 ({node_name}): {e}")
+        finally:
+            plt.close()
+
     def _plot_node_metric(self, node_name, files, key, output_dir):
         """
         绘制单个节点、单个指标的聚合图 (支持系统级指标叠加)
@@ -70,7 +151,7 @@ class Plotter:
             try:
                 df = pd.read_csv(csv_file)
                 if 'Timestamp' in df.columns and not df.empty:
-                    df['Timestamp'] = pd.to_datetime(df['Timestamp'])
+                    df['Timestamp'] = parse_timestamps(df['Timestamp'])
                     start_ts = df['Timestamp'].min()
                     
                     if min_timestamp is None or start_ts < min_timestamp:
@@ -98,7 +179,7 @@ class Plotter:
                 if os.path.exists(sys_mem_path):
                     df_sys = pd.read_csv(sys_mem_path)
                     if 'Timestamp' in df_sys.columns and not df_sys.empty:
-                        df_sys['Timestamp'] = pd.to_datetime(df_sys['Timestamp'])
+                        df_sys['Timestamp'] = parse_timestamps(df_sys['Timestamp'])
                         df_sys = df_sys[df_sys['Timestamp'] >= min_timestamp]
                         if not df_sys.empty:
                             data_frames.append({'type': 'system', 'label': 'System Total', 'df': df_sys})
@@ -3,14 +3,106 @@ import os
 import csv
 import glob
 import re
+import numpy as np
 import pandas as pd
+from dmxperf.analysis.time import parse_timestamps
 
 class Reporter:
+    # 汇总列名 -> proc_detail.csv 中的列 (均为每秒速率的均值)
+    PROC_DETAIL_COLS = [
+        ("average_io_read(KB/s)", "IoRead_KBps"),
+        ("average_io_write(KB/s)", "IoWrite_KBps"),
+        ("average_ctx_voluntary(/s)", "CtxVol_per_s"),
+        ("average_ctx_nonvoluntary(/s)", "CtxNonvol_per_s"),
+        ("average_minor_faults(/s)", "MinFlt_per_s"),
+        ("average_major_faults(/s)", "MajFlt_per_s"),
+    ]
+
+    # 能耗汇总列 (需 gpu_devices.csv 中的 Energy(J) 累计计数，缺失留空)
+    ENERGY_COLS = ["init_energy(J)", "solve_energy(J)", "energy_to_solution(J)", "average_gpu_power(W)"]
+
     def __init__(self, run_root, config):
         self.run_root = run_root
         self.metrics_root = os.path.join(run_root, "metrics")
         self.report_dir = os.path.join(run_root, "report")
         self.config = config
+        self._energy_cache = {}
+
+    def _load_gpu_energy(self, node_dir):
+        """读取节点 gpu_devices.csv 的累计能耗，返回 {gpu_id: (时间 ns 数组, 焦耳数组)}"""
+        if node_dir in self._energy_cache:
+            return self._energy_cache[node_dir]
+        res = {}
+        path = os.path.join(node_dir, "gpu_devices.csv")
+        try:
+            df = pd.read_csv(path, usecols=['Timestamp', 'GPU', 'Energy(J)'])
+            df['Timestamp'] = parse_timestamps(df['Timestamp'])
+            df['Energy(J)'] = pd.to_numeric(df['Energy(J)'], errors='coerce')
+            df = df.dropna()
+            for gpu_id, g in df.groupby('GPU'):
+                g = g.sort_values('Timestamp')
+                res[str(int(gpu_id))] = (g['Timestamp'].values.astype('int64'), g['Energy(J)'].values)
+        except Exception:
+            pass
+        self._energy_cache[node_dir] = res
+        return res
+
+    def _gpu_sharing(self, csv_files):
+        """统计每张卡被多少个 PID 使用: {(node_dir, gpu_id): n}，共享卡的能耗按 PID 均分"""
+        sharing = {}
+        for f in csv_files:
+            try: cols = pd.read_csv(f, nrows=0).columns
+            except Exception: continue
+            node_dir = os.path.dirname(os.path.dirname(f))
+            for gid in {m.group(1) for m in (re.search(r'gpu(\d+)_', c, re.IGNORECASE) for c in cols) if m}:
+                sharing[(node_dir, gid)] = sharing.get((node_dir, gid), 0) + 1
+        return sharing
+
+    def _first_sample(self, metrics_csv):
+        """DataCollector 记录的首个进程样本时刻 (ns)，早于合并后因 GPU 列缺失被删掉的行；缺失时返回 None"""
+        try:
+            with open(metrics_csv[:-len("_metrics.csv")] + "_first_sample.txt", encoding='utf-8') as fh:
+                return parse_timestamps(pd.Series([fh.read().strip()])).iloc[0].value
+        except Exception:
+            return None
+
+    def _energy_stats(self, group, node_dir, gpu_ids, times, sharing, origin=None):
+        """
+        按阶段差分累计能耗计数得到焦耳数 (不受功率采样间隔影响)。
+        以该 PID 首个进程样本 (origin，缺失时取合并后第一条样本) 为 Rank 启动时刻 (WallTime_s 的 t0)，
+        各阶段边界 = 启动时刻 + (tX - t0):
+          init = [t0, t1]，solve = [t2, t3]，energy_to_solution = [t0, t3] (无 t3 时取到数据末尾)
+        """
+        empty = dict.fromkeys(self.ENERGY_COLS, "")
+        energy = self._load_gpu_energy(node_dir)
+        gpus = [g for g in gpu_ids if g in energy]
+        if not gpus or 'Timestamp' not in group.columns: return empty
+        ts = parse_timestamps(group['Timestamp'])
+        if origin is None: origin = ts.min().value
+        last = ts.max().value
+
+        t0 = times.get('t0', 0.0) or 0.0
+        t1, t2, t3 = times.get('t1'), times.get('t2'), times.get('t3')
+        at = lambda t: origin + int((t - t0) * 1e9)
+        end = at(t3) if t3 is not None and t3 > t0 else last
+
+        def joules(a, b):
+            total = 0.0
+            for g in gpus:
+                x, y = energy[g]
+                total += (np.interp(b, x, y) - np.interp(a, x, y)) / sharing.get((node_dir, g), 1)
+            return total
+
+        res = dict(empty)
+        if t1 is not None and t1 > t0:
+            res["init_energy(J)"] = round(float(joules(origin, at(t1))), 1)
+        if t2 is not None and t3 is not None and t3 > t2:
+            res["solve_energy(J)"] = round(float(joules(at(t2), at(t3))), 1)
+        ets = float(joules(origin, end))
+        res["energy_to_solution(J)"] = round(ets, 1)
+        duration = (end - origin) / 1e9
+        res["average_gpu_power(W)"] = round(ets / duration, 1) if duration > 0 else ""
+        return res
 
     def _find_col(self, df, candidates):
         """查找匹配的列名（不区分大小写）"""
@@ -73,6 +165,7 @@ class Reporter:
                 csv_files = glob.glob(os.path.join(timeseries_dir, "**", "*_metrics.csv"), recursive=True)
                 
                 if not csv_files: continue
+                sharing = self._gpu_sharing(csv_files)
 
                 for f in csv_files:
                     try:
@@ -120,6 +213,7 @@ class Reporter:
                             rank_str = str(int(rank)) if rank != -1 else "0"
                             p_init = 0.0
                             p_solve = 0.0
+                            p_data = {}
                             
                             if rank_str in ranks_time_data:
                                 # 如果找到了该 Rank 的特定时间
@@ -129,6 +223,7 @@ class Reporter:
                             else:
                                 # 如果没找到（例如 Rank 0 才有日志），尝试回退到 Rank 0 的数据
                                 if "0" in ranks_time_data:
+                                    p_data = ranks_time_data["0"]
                                     p_init = ranks_time_data["0"].get('init', 0.0)
                                     p_solve = ranks_time_data["0"].get('solve', 0.0)
                             
@@ -158,6 +253,12 @@ class Reporter:
                             cpu_col = self._find_col(group, ['proc_cpu_util', 'cpu_util', 'cpu', 'CPU'])
                             avg_cpu = round(group[cpu_col].mean(), 2) if cpu_col else 0
                             
+                            # (2.1) 进程 IO / 上下文切换 / 缺页 (Agent 开启 proc_detail 时才有，缺失留空)
+                            detail_vals = {}
+                            for label, suffix in self.PROC_DETAIL_COLS:
+                                col = f"proc_detail_{suffix}"
+                                detail_vals[label] = round(group[col].mean(), 2) if col in group.columns else ""
+
                             # (3) GPU 指标
                             gpu_mem_cols = [c for c in group.columns if 'gpu' in c.lower() and 'mem' in c.lower()]
                             gpu_util_cols = [c for c in group.columns if 'gpu' in c.lower() and 'util' in c.lower()]
@@ -197,6 +298,12 @@ class Reporter:
                                 "init_duration(s)": f"{p_init:.4f}",
                                 "solve_duration(s)": f"{p_solve:.4f}"
                             }
+                            row.update(detail_vals)
+
+                            # (4) GPU 能耗 (累计计数差分)
+                            node_dir = os.path.dirname(os.path.dirname(f))
+                            row.update(self._energy_stats(group, node_dir, sorted(detected_gpu_ids), p_data, sharing,
+                                                          self._first_sample(f)))
                             summary_rows.append(row)
 
                     except Exception as e:
@@ -1,6 +1,20 @@
 # -*- coding: utf-8 -*-
 import os
 import pandas as pd
+from dateutil.tz import tzlocal
+
+def parse_timestamps(series):
+    """
+    解析 Agent 写出的 Timestamp 列:
+    - 新格式: epoch 纳秒整数，转换为本地时间 (与旧格式保持同一时区语义)；
+      按每个样本自己的 UTC 偏移换算 (dateutil tzlocal 带夏令时规则)，跨夏令时切换的运行不会整体错一小时
+    - 旧格式: "%Y-%m-%d %H:%M:%S" 字符串
+    返回不带时区的本地时间
+    """
+    if pd.api.types.is_numeric_dtype(series):
+        local = pd.to_datetime(series.astype('int64'), unit='ns', utc=True).dt.tz_convert(tzlocal())
+        return local.dt.tz_localize(None)
+    return pd.to_datetime(series)
 
 class TimeAnalyzer:
     def __init__(self):
@@ -19,11 +33,13 @@ class TimeAnalyzer:
             "global_init_end": 10.5,
             "global_solve_start": 12.0,
             "ranks": {
-                "0": {"init": 1.2, "solve": 50.1},
-                "1": {"init": 1.3, "solve": 50.0},
+                "0": {"init": 1.2, "solve": 50.1, "t0": 0.3, "t1": 1.5, "t2": 2.0, "t3": 52.1},
+                "1": {"init": 1.3, "solve": 50.0, ...},
                 ...
             }
         }
+        t0..t3 为该 Rank 的原始 WallTime_s 标记 (启动 / 全局 Init 结束 / 全局 Solve 开始 / 本地 Solve 结束，
+        t3 缺失时为 None)，供按阶段切分时序数据 (如能耗) 使用。
         """
         result = {"ranks": {}}
 
@@ -84,7 +100,8 @@ class TimeAnalyzer:
                 
                 result["ranks"][rank] = {
                     "init": round(init_val, 4),
-                    "solve": round(solve_val, 4)
+                    "solve": round(solve_val, 4),
+                    "t0": local_t0, "t1": global_t1, "t2": global_t2, "t3": local_t3
                 }
 
         except Exception as e:
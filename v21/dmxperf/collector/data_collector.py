@@ -3,6 +3,7 @@ import os
 import glob
 import pandas as pd
 import re
+from dmxperf.analysis.time import parse_timestamps
 
 class DataCollector:
     def __init__(self):
@@ -19,6 +20,11 @@ class DataCollector:
         found_pid = False
         for node_dir in node_dirs:
             if not os.path.isdir(node_dir): continue
+
+            # long 布局: 每节点每 Agent 一个 *_samples.csv，一次读入后按 PID 拆分
+            long_files = glob.glob(os.path.join(node_dir, "*_samples.csv"))
+            if long_files:
+                found_pid = self._process_long_files(node_dir, long_files) or found_pid
             
             pid_dirs = glob.glob(os.path.join(node_dir, "*PID*"))
             for pid_dir in pid_dirs:
@@ -55,7 +61,7 @@ class DataCollector:
                 
                 # 检查 Timestamp
                 if 'Timestamp' in df.columns:
-                    df['Timestamp'] = pd.to_datetime(df['Timestamp'])
+                    df['Timestamp'] = parse_timestamps(df['Timestamp'])
                     df.set_index('Timestamp', inplace=True)
                     df.sort_index(inplace=True) # merge_asof 必须排序
                     
@@ -84,16 +90,69 @@ class DataCollector:
             # print(f"     ⚠️ {pid_dir} 中没有加载到任何有效的 DataFrame，跳过聚合。")
             return
 
+        self._merge_and_write(dfs, pid_dir, csv_files)
+
+    def _process_long_files(self, node_dir, long_files):
+        """
+        读取 long 布局文件 (Timestamp,PID,Metric,Value)，按 PID 透视成与宽表相同的列
+        (proc_cpu_util / gpu0_Util(%) ...)，再走同一套合并逻辑，
+        结果写入 <node>-PID<pid>/<node>_PID<pid>_metrics.csv，保证 Reporter/Plotter 无需区分布局。
+        """
+        node_name = os.path.basename(node_dir)
+        per_pid = {}  # pid -> [df, ...]
+        for f in long_files:
+            try:
+                df = pd.read_csv(f)
+            except pd.errors.EmptyDataError:
+                continue
+            except Exception as e:
+                print(f"     ❌ 读取出错 {os.path.basename(f)}: {e}")
+                continue
+            if df.empty or not {'Timestamp', 'PID', 'Metric', 'Value'}.issubset(df.columns):
+                continue
+
+            df['Timestamp'] = parse_timestamps(df['Timestamp'])
+            df['Value'] = pd.to_numeric(df['Value'], errors='coerce')
+            # GPU 指标按卡拆成独立 DataFrame，与宽表 gpuN.csv 的合并语义保持一致
+            df['Group'] = df['Metric'].str.extract(r'^(gpu\d+)_', expand=False).fillna('proc')
+
+            for (pid, _), g in df.groupby(['PID', 'Group']):
+                wide = g.pivot_table(index='Timestamp', columns='Metric', values='Value', aggfunc='last')
+                wide.columns.name = None
+                wide.sort_index(inplace=True)
+                per_pid.setdefault(pid, []).append(wide)
+
+        if not per_pid:
+            return False
+
+        ok = True
+        for pid, dfs in per_pid.items():
+            pid_dir = os.path.join(node_dir, f"{node_name}-PID{pid}")
+            os.makedirs(pid_dir, exist_ok=True)
+            ok = self._merge_and_write(dfs, pid_dir, []) and ok
+
+        # 全部 PID 聚合成功后再删除原始 long 文件
+        if ok:
+            for f in long_files:
+                try: os.remove(f)
+                except Exception as e:
+                    print(f"     ⚠️ 删除冗余文件失败 {os.path.basename(f)}: {e}")
+        return True
+
+    def _merge_and_write(self, dfs, pid_dir, csv_files):
         try:
             # === 智能容错合并 ===
             base_df = None
             gpu_dfs = []
+            first_sample = None  # 首个进程 (CPU/Mem) 样本时刻，取自合并与 dropna 之前
 
             for df in dfs:
                 # 简单判断是否 GPU 数据
                 is_gpu = any("gpu" in c.lower() for c in df.columns)
                 
                 if not is_gpu:
+                    if len(df.index) and (first_sample is None or df.index.min() < first_sample):
+                        first_sample = df.index.min()
                     # CPU/Mem 数据严格合并
                     if base_df is None:
                         base_df = df
@@ -110,22 +169,30 @@ class DataCollector:
             
             if base_df is None:
                 print("     ❌ 无法确定基准数据 (Base DF is None)，无法合并。")
-                return
+                return False
 
             final_df = base_df
             
-            # 将 GPU 数据挂载 (容忍 2s 误差)
+            # 将 GPU 数据挂载: 两个 Agent 独立采样，容忍一个采样周期的错位
+            # (按基准数据的中位间隔估计周期；无法估计时沿用 1s)
+            tolerance = pd.Timedelta('1s')
+            if len(final_df.index) > 1:
+                spacing = final_df.index.to_series().diff().median()
+                if pd.notna(spacing) and spacing > pd.Timedelta(0):
+                    tolerance = spacing
             for gdf in gpu_dfs:
                 final_df = pd.merge_asof(
                     final_df, 
                     gdf, 
                     left_index=True, 
                     right_index=True, 
-                    tolerance=pd.Timedelta('1s'), 
+                    tolerance=tolerance, 
                     direction='nearest'
                 )
 
-            # 清洗空值
+            # 清洗空值: 先去掉整列为空的可选指标 (如该卡不支持的 NVLink/PCIe 字段)，
+            # 否则逐行 dropna 会把所有行都删掉
+            final_df.dropna(axis=1, how='all', inplace=True)
             final_df.dropna(inplace=True)
             
             # 排序列
@@ -146,6 +213,12 @@ class DataCollector:
             
             # 写入聚合文件
             final_df.to_csv(output_path)
+
+            # GPU 列要等 Device Agent 发现该 PID 后才有值，逐行 dropna 后首行晚于 Rank 启动；
+            # 另存首个进程样本时刻，供 Reporter 作为能耗阶段的起点
+            if first_sample is not None:
+                with open(output_path[:-len("_metrics.csv")] + "_first_sample.txt", 'w', encoding='utf-8') as fh:
+                    fh.write(f"{first_sample}\n")
             # print(f"     ✅ 已生成: {output_name} ({len(final_df)} 行)")
             
             # === [新增逻辑] 清理冗余的原始 CSV 文件 ===
@@ -162,8 +235,10 @@ class DataCollector:
             
             # if deleted_count > 0:
             #     print(f"     🧹 已清理 {deleted_count} 个原始数据文件")
+            return True
             
         except Exception as e:
             print(f"     ❌ 合并写入过程发生异常: {e}")
             import traceback
-            traceback.print_exc()
\ No newline at end of file
+            traceback.print_exc()
+            return False
\ No newline at end of file
@@ -1,6 +1,5 @@
 # dmxperf/controller/controller.py
 # -*- coding: utf-8 -*-
-import time
 import os
 import datetime
 import json
@@ -9,6 +8,7 @@ import traceback
 
 from dmxperf.task.task_runner import TaskRunner
 from dmxperf.monitor.manager import MonitorManager
+from dmxperf.infra.executor import SSHExecutor
 from dmxperf.collector.data_collector import DataCollector 
 from dmxperf.collector.walltime_collector import WalltimeParser
 from dmxperf.analysis.reporter import Reporter 
@@ -35,7 +35,16 @@ class PerfController:
         print(f"   > Interval: {self.global_cfg.get('interval', 1)}s")
         print(f"   > Clean Output: {self.global_cfg.get('clean_solver_results', False)}")
 
-        self.monitor_manager = MonitorManager(self.run_root, dry_run)
+        # 整个 Controller 运行期间每个节点复用一条 ssh 主连接，最终清理时关闭
+        # (ssh_control_persist: 主连接空闲多久后自行退出，ssh_config 时间语法)
+        if self.global_cfg.get('ssh_multiplex', True) and not dry_run:
+            SSHExecutor.enable_multiplexing(str(self.global_cfg.get('ssh_control_persist', '10m')))
+
+        # 远程节点数超过 tree_threshold 时 Agent 启停经 tree_fanout 个中继分发 (0 关闭)
+        self.monitor_manager = MonitorManager(self.run_root, dry_run,
+                                              int(self.global_cfg.get('fanout_workers', 64)),
+                                              int(self.global_cfg.get('tree_threshold', 512)),
+                                              int(self.global_cfg.get('tree_fanout', 32)))
         
         self.collector = DataCollector()
         self.time_analyzer = TimeAnalyzer() 
@@ -71,9 +80,6 @@ class PerfController:
                         run_job['case_name'] = f"{base_case_name}_{k+1}"
                     
                     self._run_single_job(run_job, current_run_idx)
-                    
-                    if current_run_idx < total_runs:
-                        time.sleep(1)
                     current_run_idx += 1
 
             if not self.dry_run: 
@@ -130,6 +136,13 @@ class PerfController:
                      gpus_per_proc = job['node_layout'][0].get('gpus_per_proc', 1)
 
                 ts_root = ctx.paths.get('timeseries') if ctx.paths else None
+                layout = job.get('sample_layout', self.global_cfg.get('sample_layout', 'wide'))
+                system_detail = job.get('system_detail', self.global_cfg.get('system_detail', False))
+                ib_errors = job.get('ib_errors', self.global_cfg.get('ib_errors', False))
+                proc_detail = job.get('proc_detail', self.global_cfg.get('proc_detail', False))
+                queue_policy = job.get('queue_policy', self.global_cfg.get('queue_policy', 'spill'))
+                unified_agent = job.get('unified_agent', self.global_cfg.get('unified_agent', False))
+                gpu_detail = job.get('gpu_detail', self.global_cfg.get('gpu_detail', False))
 
                 print(f"│   ├── Deploying Agents... ", end="", flush=True)
                 self.monitor_manager.start(
@@ -138,10 +151,19 @@ class PerfController:
                     interval=interval, 
                     gpus_per_proc=gpus_per_proc,
                     timeseries_root=ts_root,
-                    silent=True
+                    silent=True,
+                    layout=layout,
+                    system_detail=system_detail,
+                    ib_errors=ib_errors,
+                    proc_detail=proc_detail,
+                    queue_policy=queue_policy,
+                    unified=unified_agent,
+                    gpu_detail=gpu_detail
                 )
-                print("OK")
-                if not self.dry_run: time.sleep(1)
+                # 等待各 Agent 完成首个 tick 再启动求解器，取代固定 sleep
+                ready, expected = self.monitor_manager.wait_ready(
+                    float(job.get('agent_ready_timeout', self.global_cfg.get('agent_ready_timeout', 30))))
+                print("OK" if ready >= expected else f"Partial ({ready}/{expected} ready)")
             
             # === 3. Task Run (始终显示) ===
             print(f"├── 🏃 [TaskRunner] Execution")
@@ -159,7 +181,9 @@ class PerfController:
             if need_monitor:
                 print(f"├── 🛑 [Monitor] Stop")
                 print(f"│   ├── Sending Signal... ", end="", flush=True)
-                self.monitor_manager.stop(nodes_list, silent=True)
+                # stop 会等到各 Agent 写出 done 标记 (数据已 fsync) 或超时
+                self.monitor_manager.stop(nodes_list, silent=True, timeout=float(
+                    job.get('agent_stop_timeout', self.global_cfg.get('agent_stop_timeout', 30))))
                 print("OK")
 
             # === 5. Analysis (仅在需要时显示) ===
@@ -168,8 +192,6 @@ class PerfController:
                 print(f"└── 📊 [Analysis] Post-Process")
                 
                 if not self.dry_run:
-                    time.sleep(3) 
-                    
                     if ctx.paths and ctx.paths.get('timeseries'):
                         self.collector.aggregate(ctx.paths['timeseries'])
                         print(f"    ├── Data: Aggregation success")
@@ -191,7 +213,11 @@ class PerfController:
                     if job.get('visualize'): 
                         self.plotter.plot_job(case_name, job['visualize'])
                         if "network" in job.get('visualize', []):
-                            self.network_plotter.plot_cluster_network(case_name)
+                            # xmit_wait_threshold: 端口发送等待时间占比 (0~1)；xmit_wait_tick_ns: 计数 tick 时长
+                            self.network_plotter.plot_cluster_network(
+                                case_name,
+                                float(job.get('xmit_wait_threshold', self.global_cfg.get('xmit_wait_threshold', 0.05))),
+                                job.get('xmit_wait_tick_ns', self.global_cfg.get('xmit_wait_tick_ns')))
                         print(f"    └── Plots: Generated")
 
             print("") # 空行分隔任务
@@ -210,6 +236,7 @@ class PerfController:
             print("OK")
         except:
             print("Failed")
+        SSHExecutor.close_multiplexing(int(self.global_cfg.get('fanout_workers', 64)))
         print("👋 Controller Exited.")
 
     def _load_config_from_file(self, path):
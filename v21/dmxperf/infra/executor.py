@@ -1,8 +1,31 @@
 # dmxperf/infra/executor.py
 # -*- coding: utf-8 -*-
 import subprocess
-import socket
 import os
+import sys
+import time
+import shlex
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dmxperf.infra import relay
+
+def background_cmd(cmd, log_file="/dev/null"):
+    """
+    包装为后台命令 (cmd ... &)；stdin 重定向到 /dev/null，
+    远端 shell 退出后 ssh 即返回，不会被后台进程拖住
+    """
+    return f"{cmd} < /dev/null > {log_file} 2>&1 &"
+
+# 本机判定与中继保持一致
+is_local_node = relay.is_local
+
+def relay_script():
+    """中继脚本在共享文件系统上的路径 (打包模式与 Agent 同放在 release/bin)"""
+    if getattr(sys, 'frozen', False):
+        return os.path.join(os.path.dirname(os.path.abspath(sys.executable)), "dmx_relay.py")
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "relay.py")
 
 class BaseExecutor:
     def __init__(self, node, dry_run=False):
@@ -11,12 +34,7 @@ class BaseExecutor:
         self.is_local = self._check_is_local(node)
 
     def _check_is_local(self, node):
-        if node in ["localhost", "127.0.0.1"]:
-            return True
-        try:
-            return node == socket.gethostname()
-        except:
-            return False
+        return is_local_node(node)
 
     def run(self, cmd, env=None, timeout=None, ignore_errors=None):
         """
@@ -25,11 +43,66 @@ class BaseExecutor:
         """
         raise NotImplementedError
 
-    def exec_background(self, cmd, log_file="/dev/null"):
-        """后台非阻塞执行"""
+    def exec_background(self, cmd, log_file="/dev/null", wait=False):
+        """
+        后台执行 (进程脱离当前会话继续运行)
+        :param wait: 为 True 时等待启动命令 (ssh) 返回并给出返回码，否则立即返回 None
+        """
         raise NotImplementedError
 
 class SSHExecutor(BaseExecutor):
+    """
+    远程命令经 ssh 执行。enable_multiplexing() 之后每个节点复用一条 ControlMaster 主连接:
+    首次命令建立主连接 (后台常驻)，此后的 run/exec_background/工作负载分发
+    只在已认证的连接上开新通道，省去每次的 TCP 握手、密钥交换与认证。
+    主连接在 close_multiplexing() 中逐节点 "ssh -O exit" 关闭 (Controller 最终清理阶段调用)；
+    ControlPersist 为有限的空闲时间，Controller 异常退出未走到清理时主连接也会自行退出，
+    长作业期间空闲超时后下一条命令自动重建。
+    ssh 可执行文件可用环境变量 DMX_SSH 替换 (测试时指向本地替身 dmxperf/tools/fake_ssh.sh)。
+    """
+    SSH_BIN = os.environ.get("DMX_SSH", "ssh")
+    control_dir = None      # None 表示不复用
+    control_persist = "10m" # 主连接空闲保持时间 (ssh_config ControlPersist 语法)
+    _mux_nodes = set()
+    _mux_lock = threading.Lock()
+
+    @classmethod
+    def enable_multiplexing(cls, persist="10m"):
+        """开启连接复用; 控制 socket 放在 /tmp 下的短路径 (UNIX socket 路径长度上限约 108 字节)"""
+        if cls.control_dir: return
+        cls.control_dir = tempfile.mkdtemp(prefix="dmx_ssh_")
+        cls.control_persist = persist
+
+    @classmethod
+    def ssh_prefix(cls, node):
+        """返回 "ssh <选项> <node>"，远程命令字符串由调用方拼接在后面"""
+        opts = "-o StrictHostKeyChecking=no"
+        if cls.control_dir:
+            opts += (f" -o ControlMaster=auto -o ControlPath={cls.control_dir}/%C"
+                     f" -o ControlPersist={cls.control_persist}")
+            with cls._mux_lock:
+                cls._mux_nodes.add(node)
+        return f"{cls.SSH_BIN} {opts} {node}"
+
+    @classmethod
+    def close_multiplexing(cls, max_workers=64):
+        """关闭所有节点的主连接并删除控制目录 (未开启复用时为空操作)"""
+        if not cls.control_dir: return
+        with cls._mux_lock:
+            nodes = sorted(cls._mux_nodes)
+            cls._mux_nodes.clear()
+        control_path = f"{cls.control_dir}/%C"
+
+        def close(executor):
+            # 主连接已因网络中断退出时 -O exit 返回 255，不视为错误
+            subprocess.run([cls.SSH_BIN, "-o", f"ControlPath={control_path}", "-O", "exit", executor.node],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10)
+            return 0
+
+        fan_out(nodes, close, max_workers=max_workers)
+        shutil.rmtree(cls.control_dir, ignore_errors=True)
+        cls.control_dir = None
+
     def run(self, cmd, env=None, timeout=None, ignore_errors=None):
         """
         在远程或本地执行命令并等待结果。
@@ -42,7 +115,7 @@ class SSHExecutor(BaseExecutor):
         final_cmd = cmd
         if not self.is_local:
             # 简单的 SSH 封装
-            final_cmd = f"ssh -o StrictHostKeyChecking=no {self.node} '{cmd}'"
+            final_cmd = f"{self.ssh_prefix(self.node)} '{cmd}'"
 
         try:
             # 使用 shell=True 允许使用管道符和逻辑符 (&&, |)
@@ -74,18 +147,21 @@ class SSHExecutor(BaseExecutor):
             print(f"❌ [Executor] {self.node} 执行异常: {e}")
             return -1
 
-    def exec_background(self, cmd, log_file="/dev/null"):
+    def exec_background(self, cmd, log_file="/dev/null", wait=False):
         """
         启动后台进程 (nohup ... &)
         """
-        bg_cmd = f"{cmd} > {log_file} 2>&1 &"
+        bg_cmd = background_cmd(cmd, log_file)
         
         if self.dry_run:
-            return
+            return 0 if wait else None
+
+        if wait:
+            return self.run(bg_cmd)
 
         final_cmd = bg_cmd
         if not self.is_local:
-            final_cmd = f"ssh -o StrictHostKeyChecking=no {self.node} '{bg_cmd}'"
+            final_cmd = f"{self.ssh_prefix(self.node)} '{bg_cmd}'"
 
         try:
             subprocess.Popen(final_cmd, shell=True, executable='/bin/bash')
@@ -95,4 +171,85 @@ class SSHExecutor(BaseExecutor):
 class ExecutorFactory:
     @staticmethod
     def create(node, dry_run=False):
-        return SSHExecutor(node, dry_run)
\ No newline at end of file
+        return SSHExecutor(node, dry_run)
+
+class NodeResult:
+    """单个节点的扇出结果: 返回码 (0 为成功) 与耗时 (秒)"""
+    __slots__ = ("node", "code", "latency")
+
+    def __init__(self, node, code, latency):
+        self.node = node
+        self.code = code
+        self.latency = latency
+
+    def __repr__(self):
+        return f"NodeResult({self.node}, code={self.code}, {self.latency * 1000:.0f}ms)"
+
+def fan_out(nodes, action, dry_run=False, max_workers=64):
+    """
+    对每个节点并发执行 action(executor) -> 返回码，线程池大小受 max_workers 限制
+    (每个任务主要在等 ssh 子进程，线程数即同时在途的 ssh 连接数)。
+    总耗时约等于最慢的节点，而非所有节点之和。返回按 nodes 顺序排列的 NodeResult 列表。
+    """
+    def task(node):
+        t0 = time.monotonic()
+        try:
+            code = action(ExecutorFactory.create(node, dry_run))
+        except Exception as e:
+            print(f"❌ [Executor] {node} 执行异常: {e}")
+            code = -1
+        return NodeResult(node, code or 0, time.monotonic() - t0)
+
+    nodes = list(nodes)
+    if not nodes: return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(nodes)))) as pool:
+        return list(pool.map(task, nodes))
+
+def tree_spec(node_cmds, fanout=32, leaf_max=64, max_workers=64):
+    """构造中继 spec (node_cmds: [(node, cmd)])"""
+    return {"items": [[n, c] for n, c in node_cmds], "fanout": fanout, "leaf_max": leaf_max,
+            "workers": max_workers, "relay": relay_script()}
+
+def tree_dispatch_cmd(node_cmds, fanout=32, leaf_max=64, max_workers=64):
+    """返回在本机启动树状分发的 shell 命令 (供工作负载作为 cmd_string 交给 TaskRunner 执行)"""
+    spec = tree_spec(node_cmds, fanout, leaf_max, max_workers)
+    return f"python3 {relay_script()} {relay.encode_spec(spec)}"
+
+def tree_fan_out(node_cmds, dry_run=False, fanout=32, leaf_max=64, max_workers=64):
+    """
+    经中继树在各节点执行各自的命令: 本机只连接 fanout 个中继，中继再向各自的子树分发并汇总结果。
+    第一层连接走 SSHExecutor.ssh_prefix (开启复用时共享主连接)。返回按 node_cmds 顺序的 NodeResult 列表。
+    """
+    node_cmds = list(node_cmds)
+    if dry_run:
+        return [NodeResult(n, 0, 0.0) for n, _ in node_cmds]
+    results = {}
+    def emit(r):
+        results[r["node"]] = NodeResult(r["node"], r["code"], r["latency"])
+    spec = tree_spec(node_cmds, fanout, leaf_max, max_workers)
+    relay.dispatch(spec, emit, ssh_prefix=lambda node: shlex.split(SSHExecutor.ssh_prefix(node)))
+    return [results.get(n, NodeResult(n, -1, 0.0)) for n, _ in node_cmds]
+
+def run_on_nodes(node_cmds, dry_run=False, max_workers=64, ignore_errors=None, tree_threshold=0, tree_fanout=32):
+    """
+    在各节点执行各自的命令 (node_cmds: [(node, cmd)])，返回按输入顺序的 NodeResult 列表。
+    远程节点数超过 tree_threshold (>0) 时经中继树分发，否则由本机直接并发 ssh (fan_out)。
+    ignore_errors 中的返回码视为成功 (同 SSHExecutor.run)。
+    """
+    node_cmds = list(node_cmds)
+    cmds = dict(node_cmds)
+    remote = [(n, c) for n, c in node_cmds if not is_local_node(n)]
+    if not (tree_threshold and len(remote) > tree_threshold):
+        return fan_out([n for n, _ in node_cmds], lambda ex: ex.run(cmds[ex.node], ignore_errors=ignore_errors),
+                       dry_run, max_workers)
+
+    results = {r.node: r for r in tree_fan_out(remote, dry_run, tree_fanout, max_workers, max_workers)}
+    local = [n for n, _ in node_cmds if is_local_node(n)]
+    for r in fan_out(local, lambda ex: ex.run(cmds[ex.node], ignore_errors=ignore_errors), dry_run, max_workers):
+        results[r.node] = r
+    for r in results.values():
+        if ignore_errors and r.code in ignore_errors:
+            r.code = 0
+        elif r.code != 0 and not is_local_node(r.node):
+            print(f"⚠️ [Executor] {r.node} 命令异常 (Code: {r.code})")
+    return [results[n] for n, _ in node_cmds]
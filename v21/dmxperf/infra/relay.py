@@ -0,0 +1,134 @@
+# dmxperf/infra/relay.py
+# -*- coding: utf-8 -*-
+"""
+树状扇出中继 (仅依赖标准库，可脱离 dmxperf 包由节点 python3 直接运行):
+
+    python3 relay.py <base64(zlib(JSON spec))>
+
+spec = {"items": [[node, cmd], ...], "fanout": k, "leaf_max": m, "workers": w, "relay": 本脚本路径}
+- 远程条目不超过 leaf_max: 本节点直接并发 ssh 到每个节点执行 cmd；
+- 否则按节点列表顺序切成 k 段，每段第一个节点作为下一级中继，经 ssh 在该节点上运行本脚本
+  (共享文件系统上的同一路径，与 Agent 的部署方式相同) 处理整段，中继自身的条目由它在本地执行。
+- 属于本机的条目与远程条目同时在本地执行 (中继节点自己的长命令，如硬件测试，不会排在整段子树之后)。
+
+每个节点的结果以一行 JSON 写到 stdout: {"node": ..., "code": ..., "latency": ...}，上级中继原样转发。
+下级中继整体失败 (连接失败/中途退出) 时，其子树中未回报的节点记为该 ssh 的返回码 (无返回码时为 -1)。
+Controller 只与 k 个中继建立连接，文件描述符与 sshd 限速压力按层分摊。
+"""
+import base64
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+SSH_BIN = os.environ.get("DMX_SSH", "ssh")
+SSH_OPTS = ["-o", "StrictHostKeyChecking=no", "-o", "BatchMode=yes"]
+
+def encode_spec(spec):
+    # 各节点命令高度相似 (仅日志名等不同)，压缩后上千节点的 spec 也远小于命令行长度上限
+    return base64.b64encode(zlib.compress(json.dumps(spec).encode())).decode()
+
+def decode_spec(text):
+    return json.loads(zlib.decompress(base64.b64decode(text)))
+
+def is_local(node):
+    if node in ["localhost", "127.0.0.1"]:
+        return True
+    try:
+        return node == socket.gethostname()
+    except:
+        return False
+
+def _ssh_argv(node, ssh_prefix):
+    return ssh_prefix(node) if ssh_prefix else [SSH_BIN] + SSH_OPTS + [node]
+
+def _run_leaf(node, cmd, ssh_prefix):
+    t0 = time.monotonic()
+    try:
+        if is_local(node):
+            code = subprocess.run(cmd, shell=True, executable='/bin/bash', stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+        else:
+            code = subprocess.run(_ssh_argv(node, ssh_prefix) + [cmd], stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+    except Exception:
+        code = -1
+    return {"node": node, "code": code, "latency": time.monotonic() - t0}
+
+def _run_relay(group, spec, ssh_prefix, emit):
+    """把一段节点交给该段第一个节点上的中继，逐行转发它回报的结果"""
+    t0 = time.monotonic()
+    relay = group[0][0]
+    sub = dict(spec, items=group)
+    remote = f"python3 {spec['relay']} {encode_spec(sub)}"
+    pending = {node for node, _ in group}
+    code = -1
+    try:
+        proc = subprocess.Popen(_ssh_argv(relay, ssh_prefix) + [remote], stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        for line in proc.stdout:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                continue
+            if r.get("node") in pending:
+                pending.discard(r["node"])
+                emit(r)
+        code = proc.wait()
+    except Exception:
+        pass
+    for node in pending:
+        emit({"node": node, "code": code or -1, "latency": time.monotonic() - t0})
+
+def dispatch(spec, emit, ssh_prefix=None):
+    """
+    执行 spec 中的全部条目，每完成一个节点调用一次 emit(dict) (emit 在调用方线程外执行时已加锁)。
+    :param ssh_prefix: node -> ssh argv 前缀 (Controller 传入以复用其 ssh 主连接)，默认普通 ssh
+    """
+    lock = threading.Lock()
+    def locked_emit(r):
+        with lock:
+            emit(r)
+
+    items = [tuple(it) for it in spec["items"]]
+    local = [it for it in items if is_local(it[0])]
+    remote = [it for it in items if not is_local(it[0])]
+    fanout = max(2, int(spec.get("fanout", 32)))
+    leaf_max = max(1, int(spec.get("leaf_max", 64)))
+    workers = max(1, int(spec.get("workers", 64)))
+
+    local_pool = ThreadPoolExecutor(max_workers=max(1, len(local)))
+    for node, cmd in local:
+        local_pool.submit(lambda n=node, c=cmd: locked_emit(_run_leaf(n, c, None)))
+    try:
+        if remote:
+            if len(remote) <= leaf_max:
+                with ThreadPoolExecutor(max_workers=min(workers, len(remote))) as pool:
+                    for r in pool.map(lambda it: _run_leaf(it[0], it[1], ssh_prefix), remote):
+                        locked_emit(r)
+            else:
+                size = -(-len(remote) // fanout)
+                groups = [remote[i:i + size] for i in range(0, len(remote), size)]
+                with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+                    list(pool.map(lambda g: _run_relay(g, spec, ssh_prefix, locked_emit), groups))
+    finally:
+        local_pool.shutdown(wait=True)
+
+def main():
+    if len(sys.argv) != 2:
+        sys.exit("usage: relay.py <base64 spec>")
+    failed = []
+    def emit(r):
+        if r["code"] != 0: failed.append(r["node"])
+        sys.stdout.write(json.dumps(r) + "\n")
+        sys.stdout.flush()
+    dispatch(decode_spec(sys.argv[1]), emit)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
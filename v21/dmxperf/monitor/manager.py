@@ -2,15 +2,27 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import glob
 import time
 import socket
-from dmxperf.infra.executor import ExecutorFactory
+from dmxperf.infra.executor import background_cmd, run_on_nodes
 
 class MonitorManager:
-    def __init__(self, run_root, dry_run=False):
+    def __init__(self, run_root, dry_run=False, max_parallel=64, tree_threshold=0, tree_fanout=32):
+        """
+        :param max_parallel: start/stop 并发扇出的最大 ssh 连接数
+        :param tree_threshold: 远程节点数超过该值时经中继树分发 (0 为关闭)
+        :param tree_fanout: 树状分发时本机直接连接的中继数
+        """
         self.run_root = run_root
         self.dry_run = dry_run
-        self.host_agent_script, self.device_agent_script = self._locate_agents()
+        self.max_parallel = max_parallel
+        self.tree_threshold = tree_threshold
+        self.tree_fanout = tree_fanout
+        self.last_results = []   # 最近一次 start/stop 的逐节点结果 (NodeResult)
+        self.active = None       # 当前一批 Agent: {"state_dir": 状态目录, "expected": Agent 个数}
+        self.state_dirs = []     # 本次运行启动过的所有批次的状态目录 (停止时只处理这些目录中登记的 Agent)
+        self.host_agent_script, self.device_agent_script, self.unified_agent_script = self._locate_agents()
         self.is_binary_mode = getattr(sys, 'frozen', False)
 
     def _locate_agents(self):
@@ -20,18 +32,109 @@ class MonitorManager:
             base_dir = os.path.dirname(os.path.abspath(sys.executable))
             host = os.path.join(base_dir, "dmx_host_agent")
             dev = os.path.join(base_dir, "dmx_device_agent")
+            unified = os.path.join(base_dir, "dmx_agent")
+            # 优先使用 zipapp 形态 (节点 python3 直接运行，无 onefile 解压开销)
+            if os.path.exists(unified + ".pyz"):
+                unified += ".pyz"
         else:
             # Source Mode (源码运行)
             base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
             host = os.path.join(base_dir, "agents", "host_agent.py")
             dev = os.path.join(base_dir, "agents", "device_agent.py")
+            unified = os.path.join(base_dir, "agents", "unified_agent.py")
         
-        return host, dev
+        return host, dev, unified
+
+    def _fan_out(self, node_cmds, verb, silent, ignore_errors=None):
+        """并发 (或经中继树) 在各节点执行各自的命令，记录逐节点返回码与耗时"""
+        t0 = time.monotonic()
+        results = run_on_nodes(node_cmds, self.dry_run, self.max_parallel, ignore_errors,
+                               self.tree_threshold, self.tree_fanout)
+        self.last_results = results
+        failed = [r for r in results if r.code != 0]
+        if failed:
+            print(f"⚠️ [Monitor] {verb}失败节点: {', '.join(f'{r.node}(Code: {r.code})' for r in failed)}")
+        if results and not silent:
+            slowest = max(results, key=lambda r: r.latency)
+            print(f"      [Monitor] {verb}完成: {len(results) - len(failed)}/{len(results)} 节点成功, "
+                  f"总耗时 {time.monotonic() - t0:.2f}s (最慢 {slowest.node} {slowest.latency:.2f}s)")
+        return results
+
+    def _markers(self, state, state_dirs=None):
+        """
+        各状态目录中已写出的 state 标记: {标记基名 (目录/.agent_<role>_<pid>): 文件内容字段}
+        同一 Agent 的 pid/ready/done 标记基名相同
+        """
+        found = {}
+        for d in (state_dirs if state_dirs is not None else [self.active["state_dir"]]):
+            for p in glob.glob(os.path.join(d, "*", f".agent_*.{state}")):
+                try:
+                    with open(p, 'r', encoding='utf-8') as f:
+                        fields = f.read().strip().split(',')
+                except OSError:
+                    fields = []
+                found[p.rsplit(".", 1)[0]] = fields
+        return found
+
+    def _finished(self, state_dirs):
+        """已正常退出 (done) 或确认进程已不存在 (gone/killed) 的 Agent"""
+        return set().union(*(self._markers(st, state_dirs) for st in ("done", "gone", "killed")))
+
+    def wait_ready(self, timeout=30.0, poll=0.1):
+        """
+        等待本批所有 Agent 写出 ready 标记 (首个 tick 已采样)，取代部署后的固定 sleep。
+        :return: (已就绪数, 期望数)；超时时打印警告后返回
+        """
+        if not self.active or self.dry_run: return 0, 0
+        expected = self.active["expected"]
+        deadline = time.monotonic() + timeout
+        while True:
+            n = len(self._markers("ready"))
+            if n >= expected: return n, expected
+            if time.monotonic() >= deadline:
+                print(f"⚠️ [Monitor] {timeout:.0f}s 内仅 {n}/{expected} 个 Agent 就绪")
+                return n, expected
+            time.sleep(poll)
+
+    def _node_of(self, host, node_list):
+        """Agent 登记目录名 (节点 hostname) -> 配置中的节点名 (可能是短名/FQDN)，匹配不上时直接用 hostname"""
+        if host in node_list: return host
+        short = host.split('.')[0]
+        for node in node_list:
+            if node.split('.')[0] == short: return node
+        return host
+
+    def _signal_cmds(self, agents, sig, node_list):
+        """
+        按节点生成信号命令: 仅当 /proc/<pid>/stat 的启动时间 (第 22 列) 与登记一致时才发信号，
+        登记了进程组 (Agent 独占会话) 时向整个进程组发送；进程已不存在时写 gone 标记。
+        """
+        by_node = {}
+        for base, (pid, start, pgid) in agents.items():
+            # 信号在前时负数即进程组；dash 的内建 kill 不认 "--"
+            target = f"-{pgid}" if pgid != "0" else pid
+            by_node.setdefault(self._node_of(os.path.basename(os.path.dirname(base)), node_list), []).append(
+                f"if alive {pid} {start}; then kill -{sig} {target} 2>/dev/null; else : > {base}.gone; fi; ")
+        # 去掉 comm 字段 (可能含空格) 后，starttime 为剩余字段中的第 20 个。
+        # 仅用 POSIX sh 语法 (登录 shell 可能是 dash)，且不含单引号 (命令整体被 ssh 包在单引号里)
+        check = ('alive() { w=$2; s=$(cat /proc/$1/stat 2>/dev/null) || return 1; set -- ${s##*) }; '
+                 '[ $# -ge 20 ] || return 1; shift 19; [ "$1" = "$w" ]; }; ')
+        return [(node, check + "".join(cmds)) for node, cmds in by_node.items()]
 
-    def start(self, node_list, target_name, interval, gpus_per_proc=1, timeseries_root=None, silent=False):
+    def start(self, node_list, target_name, interval, gpus_per_proc=1, timeseries_root=None, silent=False, layout="wide",
+              system_detail=False, ib_errors=False, proc_detail=False, queue_policy="spill",
+              unified=False, gpu_detail=False):
         """
         在指定节点列表启动 Agent
         :param silent: 是否静默启动 (不打印日志，由 Controller 统一打印)
+        :param layout: 数据布局, "wide" (每 PID 每指标一个 CSV) 或 "long" (每节点每 Agent 一个文件)
+        :param system_detail: Host Agent 是否采集每核 CPU / 负载 / vmstat / NUMA 等节点级指标
+        :param ib_errors: Host Agent 是否采集 IB 拥塞/错误计数 (network_errors.csv)
+        :param proc_detail: Host Agent 是否采集进程 IO / 上下文切换 / 缺页速率 (proc_detail.csv)
+        :param queue_policy: Agent 写队列满时的策略 ("block" / "drop_oldest" / "spill")
+        :param unified: 每节点只启动一个统一 Agent (Host/Network/GPU 插件共享调度器与写线程)
+        :param gpu_detail: GPU 采集是否追加时钟/温度/降频原因/PCIe/NVLink 列
+        :return: 逐节点 NodeResult 列表 (启动命令的返回码与耗时)
         """
         if not timeseries_root:
             timeseries_root = os.path.join(self.run_root, "metrics", target_name, "TimeSeries")
@@ -42,76 +145,103 @@ class MonitorManager:
         if not silent:
             print(f"      [Monitor] 启动监控 -> Nodes: {unique_nodes}")
 
-        # 先清理可能的残留 (静默清理)
+        # 先清理本次运行中可能残留的 Agent (静默清理)
         self.stop(unique_nodes, silent=True)
 
-        # 构建启动命令前缀
+        # 每批 Agent 一个状态目录: <run_root>/state/<序号>_<target>/<hostname>/.agent_<role>_<pid>.{pid,ready,done}
+        state_dir = os.path.join(self.run_root, "state", f"{len(self.state_dirs):03d}_{target_name}")
+        self.state_dirs.append(state_dir)
+        # expected (wait_ready 的期望 Agent 数) 在启动完成后按启动成功的节点计
+        self.active = {"state_dir": state_dir, "expected": 0}
+
+        # 构建启动命令前缀 (setsid: 每个 Agent 独占会话与进程组，停止时按组发信号不会波及其他进程)
         if self.is_binary_mode:
-            cmd_host_prefix = f"nohup {self.host_agent_script}"
-            cmd_dev_prefix  = f"nohup {self.device_agent_script}"
+            cmd_host_prefix = f"setsid nohup {self.host_agent_script}"
+            cmd_dev_prefix  = f"setsid nohup {self.device_agent_script}"
+            if self.unified_agent_script.endswith(".pyz"):
+                cmd_unified_prefix = f"setsid nohup python3 {self.unified_agent_script}"
+            else:
+                cmd_unified_prefix = f"setsid nohup {self.unified_agent_script}"
         else:
-            cmd_host_prefix = f"nohup python3 {self.host_agent_script}"
-            cmd_dev_prefix  = f"nohup python3 {self.device_agent_script}"
+            cmd_host_prefix = f"setsid nohup python3 {self.host_agent_script}"
+            cmd_dev_prefix  = f"setsid nohup python3 {self.device_agent_script}"
+            cmd_unified_prefix = f"setsid nohup python3 {self.unified_agent_script}"
 
-        for node in unique_nodes:
-            executor = ExecutorFactory.create(node, self.dry_run)
-            
-            # 1. 启动 Host Agent
-            log_host = os.path.join(self.run_root, "logs", f"agent_host_{node}.log")
-            cmd_host = (f"{cmd_host_prefix} "
-                        f"--timeseries_root {timeseries_root} "
-                        f"--target_name {target_name} "
-                        f"--interval {interval} ")
-            executor.exec_background(cmd_host, log_file=log_host)
-
-            # 2. 启动 Device Agent
-            log_dev = os.path.join(self.run_root, "logs", f"agent_device_{node}.log")
-            cmd_dev = (f"{cmd_dev_prefix} "
-                       f"--timeseries_root {timeseries_root} "
+        # 两种 Agent 共用的参数
+        common_args = (f"--timeseries_root {timeseries_root} "
                        f"--target_name {target_name} "
                        f"--interval {interval} "
-                       f"--gpus_per_proc {gpus_per_proc} ")
-            executor.exec_background(cmd_dev, log_file=log_dev)
+                       f"--layout {layout} "
+                       f"--queue_policy {queue_policy} "
+                       f"--state_dir {state_dir} ")
+        host_args = (f"{'--system_detail ' if system_detail else ''}"
+                     f"{'--ib_errors ' if ib_errors else ''}"
+                     f"{'--proc_detail ' if proc_detail else ''}")
+        dev_args = (f"--gpus_per_proc {gpus_per_proc} "
+                    f"{'--gpu_detail ' if gpu_detail else ''}")
+
+        def launch_cmd(node):
+            if unified:
+                # 统一 Agent: 一个进程、一次启动
+                log_agent = os.path.join(self.run_root, "logs", f"agent_{node}.log")
+                return background_cmd(f"{cmd_unified_prefix} {common_args}{dev_args}{host_args}", log_agent)
+
+            # Host Agent + Device Agent 在同一条远程命令中先后放入后台
+            log_host = os.path.join(self.run_root, "logs", f"agent_host_{node}.log")
+            log_dev = os.path.join(self.run_root, "logs", f"agent_device_{node}.log")
+            return (background_cmd(f"{cmd_host_prefix} {common_args}{host_args}", log_host) + " " +
+                    background_cmd(f"{cmd_dev_prefix} {common_args}{dev_args}", log_dev))
+
+        # 各节点并发启动，每节点一次 ssh；启动命令失败 (如 ssh 不通) 的节点不会写 ready，不计入期望数
+        results = self._fan_out([(node, launch_cmd(node)) for node in unique_nodes], "启动", silent)
+        self.active["expected"] = sum(1 for r in results if r.code == 0) * (1 if unified else 2)
+        return results
 
-    def stop(self, node_list, silent=False):
+    def stop(self, node_list, silent=False, timeout=30.0):
         """
-        停止指定节点上的 Agent (包含本地防误杀逻辑)
+        停止本次运行启动的 Agent: 只向状态目录中登记、且启动时间一致的 PID 发信号，
+        不再按名字 pkill -f (同一节点上其他用户/其他 dmxperf 运行的 Agent 不受影响)。
+        流程: SIGINT -> 等待 done 标记 (数据已 fsync) 直到截止时间 -> 仍未退出的 SIGKILL。
+        :param node_list: 节点名列表 (用于把 Agent 登记的 hostname 对应回 ssh 使用的节点名)
         :param silent: 是否静默停止
+        :param timeout: 等待 Agent 刷盘退出的最长秒数
+        :return: 逐节点 NodeResult 列表 (没有需要停止的 Agent 时为空)
         """
         unique_nodes = list(set(node_list))
         if not silent:
             print(f"      [Monitor] 停止监控 -> Nodes: {unique_nodes}")
-            
-        # 获取当前进程 PID (用于本地命令排除自己)
-        my_pid = os.getpid()
-
-        # === 1. 远程命令: 直接强杀 ===
-        # 先尝试 SIGINT 让 Agent 优雅落盘，再 SIGKILL
-        remote_cmd = (
-            "pkill -INT -f dmx_host_agent 2>/dev/null; "
-            "pkill -INT -f dmx_device_agent 2>/dev/null; "
-            "sleep 1; " 
-            "pkill -9 -f dmxperf/agents 2>/dev/null; "
-            "pkill -9 -f dmx_host_agent 2>/dev/null; "
-            "pkill -9 -f dmx_device_agent 2>/dev/null; "
-        )
-
-        # === 2. 本地命令: 排除自己 ===
-        # 使用 pgrep 过滤掉当前进程 PID，防止误杀 Controller 自身
-        local_cmd = (
-            f"pgrep -f dmx_host_agent | grep -v {my_pid} | xargs -r kill -2 2>/dev/null; "
-            f"pgrep -f dmx_device_agent | grep -v {my_pid} | xargs -r kill -2 2>/dev/null; "
-            "sleep 1; "
-            f"pgrep -f dmxperf/agents | grep -v {my_pid} | xargs -r kill -9 2>/dev/null; "
-            f"pgrep -f dmx_host_agent | grep -v {my_pid} | xargs -r kill -9 2>/dev/null; "
-            f"pgrep -f dmx_device_agent | grep -v {my_pid} | xargs -r kill -9 2>/dev/null; "
-        )
-
-        for node in unique_nodes:
-            executor = ExecutorFactory.create(node, self.dry_run)
-            
-            # 根据 executor 判断是否为本地节点，选择对应的命令
-            target_cmd = local_cmd if executor.is_local else remote_cmd
-            
-            # 执行命令，忽略 -9 (SIGKILL), 137 (Kill via -9), 255 (SSH error sometimes), 1 (No process found)
-            executor.run(target_cmd, ignore_errors=[-9, 137, 255, 1])
\ No newline at end of file
+        if self.dry_run or not self.state_dirs:
+            self.active = None
+            return []
+
+        # 有当前批次时只处理当前批次，否则 (残留清理/最终清理) 检查本次运行的所有批次
+        state_dirs = [self.active["state_dir"]] if self.active else self.state_dirs
+        self.active = None
+        finished = self._finished(state_dirs)
+        agents = {base: tuple(f[:3]) for base, f in self._markers("pid", state_dirs).items()
+                  if base not in finished and len(f) >= 3}
+        if not agents:
+            return []
+
+        # 1. SIGINT 让 Agent 优雅落盘
+        results = self._fan_out(self._signal_cmds(agents, "INT", unique_nodes), "停止", silent)
+        unreachable = {r.node for r in results if r.code != 0}
+
+        # 2. 等待 done/gone 标记 (不可达节点上的 Agent 无法确认，不参与等待)
+        waiting = {b for b in agents
+                   if self._node_of(os.path.basename(os.path.dirname(b)), unique_nodes) not in unreachable}
+        deadline = time.monotonic() + timeout
+        while True:
+            waiting -= self._finished(state_dirs)
+            if not waiting or time.monotonic() >= deadline: break
+            time.sleep(0.1)
+
+        # 3. 截止时间后仍未退出的才升级为 SIGKILL，并记 killed 标记
+        if waiting:
+            print(f"⚠️ [Monitor] {timeout:.0f}s 内仍有 {len(waiting)} 个 Agent 未完成落盘，强制停止")
+            stuck = {b: agents[b] for b in waiting}
+            cmds = [(node, cmd + "".join(f": > {b}.killed; " for b in stuck
+                                         if self._node_of(os.path.basename(os.path.dirname(b)), unique_nodes) == node))
+                    for node, cmd in self._signal_cmds(stuck, "KILL", unique_nodes)]
+            self._fan_out(cmds, "强制停止", True)
+        return results
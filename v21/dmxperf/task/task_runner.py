@@ -5,7 +5,7 @@ import time
 import subprocess
 import socket
 from dmxperf.workloads import WorkloadFactory
-from dmxperf.infra.executor import ExecutorFactory
+from dmxperf.infra.executor import run_on_nodes
 
 class TaskRunner:
     def __init__(self, global_config, run_root, dry_run=False):
@@ -87,6 +87,8 @@ class TaskRunner:
             
             rm_cmd = f"rm -rf {ctx.result_dir}"
             
-            for node in unique_nodes:
-                executor = ExecutorFactory.create(node, self.dry_run)
-                executor.run(rm_cmd)
\ No newline at end of file
+            # 各节点并发删除，节点数超过 tree_threshold 时经中继树分发
+            run_on_nodes([(node, rm_cmd) for node in unique_nodes], self.dry_run,
+                         int(self.global_config.get('fanout_workers', 64)), None,
+                         int(self.global_config.get('tree_threshold', 512)),
+                         int(self.global_config.get('tree_fanout', 32)))
\ No newline at end of file
@@ -0,0 +1,86 @@
+# dmxperf/tools/agent_startup_bench.py
+# -*- coding: utf-8 -*-
+"""
+Agent 启动延迟基准: 从 fork 到第一条样本写入磁盘的时间。
+
+每种形态启动 N 次，Agent 以 --flush_interval 0 运行 (首个 tick 的 system_memory.csv 行立即落盘)，
+轮询该文件出现数据行即记为"首样本"时间，随后发送 SIGINT 并等待退出。
+PyInstaller onefile 每次启动都要把解释器解压到 /tmp，pyz/源码形态直接使用节点 python3。
+
+用法:
+    python3 -m dmxperf.tools.agent_startup_bench --runs 10 \\
+        --onefile release/bin/dmx_agent --pyz release/bin/dmx_agent.pyz
+"""
+import argparse
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+AGENT_SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "agents", "unified_agent.py")
+
+def first_sample_latency(cmd, timeout=60.0):
+    """启动一次 Agent，返回到首样本落盘的秒数 (超时返回 None)"""
+    root = tempfile.mkdtemp(prefix="dmx_bench_")
+    args = cmd + ["--timeseries_root", root, "--target_name", "dmxperf_startup_bench",
+                  "--interval", "0.1", "--flush_interval", "0"]
+    t0 = time.monotonic()
+    proc = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    sample = None
+    latency = None
+    try:
+        while time.monotonic() - t0 < timeout:
+            if sample is None:
+                nodes = os.listdir(root)
+                if nodes: sample = os.path.join(root, nodes[0], "system_memory.csv")
+            if sample:
+                try:
+                    with open(sample, 'rb') as f:
+                        # 表头 + 至少一行数据
+                        if f.read().count(b'\n') >= 2:
+                            latency = time.monotonic() - t0
+                            break
+                except FileNotFoundError: pass
+            if proc.poll() is not None: break
+            time.sleep(0.001)
+    finally:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+            try: proc.wait(timeout=10)
+            except subprocess.TimeoutExpired: proc.kill(); proc.wait()
+        shutil.rmtree(root, ignore_errors=True)
+    return latency
+
+def bench(name, cmd, runs):
+    vals = []
+    for _ in range(runs):
+        v = first_sample_latency(cmd)
+        if v is not None: vals.append(v)
+    if not vals:
+        print(f"{name:<10} 失败: 未在超时内写出样本 ({' '.join(cmd)})")
+        return
+    print(f"{name:<10} n={len(vals):<3} min={min(vals) * 1000:8.1f}ms  "
+          f"median={statistics.median(vals) * 1000:8.1f}ms  max={max(vals) * 1000:8.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="比较各 Agent 形态从启动到首样本落盘的延迟")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--onefile", help="PyInstaller onefile 二进制 (如 release/bin/dmx_agent)")
+    parser.add_argument("--pyz", help="zipapp 包 (如 release/bin/dmx_agent.pyz)")
+    parser.add_argument("--python", default="python3", help="运行 pyz/源码形态的解释器")
+    args = parser.parse_args()
+
+    forms = [("source", [args.python, AGENT_SRC])]
+    if args.pyz: forms.append(("pyz", [args.python, args.pyz]))
+    if args.onefile: forms.append(("onefile", [args.onefile]))
+
+    print(f"[Bench] 每种形态运行 {args.runs} 次, 计时至首样本落盘")
+    for name, cmd in forms:
+        bench(name, cmd, args.runs)
+
+if __name__ == "__main__":
+    sys.exit(main())
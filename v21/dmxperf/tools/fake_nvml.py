@@ -0,0 +1,215 @@
+# dmxperf/tools/fake_nvml.py
+# -*- coding: utf-8 -*-
+"""
+NVML 替身与 GPU 采集自检 (无 GPU 的节点/CI 上运行)。
+
+FakeNvmlLib 用 Python 实现 NvmlNative 用到的 NVML 函数，经 NvmlNative(lib=...) /
+GpuCollector(nvml_lib=...) 注入，走与真实 libnvidia-ml 相同的调用路径 (byref 输出参数、预分配数组)。
+
+main() 驱动 NativeNvmlManager / GpuCollector / NvmlWatchdog 若干 tick 并检查:
+  - 句柄与 PCI 信息只在初始化时解析一次
+  - 进程列表缓冲不足时扩容一次，之后复用
+  - gpu_devices.csv 每 tick 覆盖每张卡，累计能耗换算为焦耳
+  - 共享卡上每个进程的 Util 取进程级 SM 利用率
+  - PCIe RX/TX 字段 ID 与 NVML 一致 (两列都有值且不互换)
+  - 挂住的卡被看门狗记为 timeout / returned，其他卡照常出数据
+
+用法:
+    python3 -m dmxperf.tools.fake_nvml
+"""
+import sys
+import time
+
+from dmxperf.agents.agent_common import PidMatcher, TickContext
+from dmxperf.agents.device_agent import GpuCollector, NativeNvmlManager
+
+class FakeNvmlLib:
+    """
+    gpus 张卡，procs = {卡号: [(pid, 显存字节), ...]}；proc_util = {卡号: [(pid, SM%), ...]}，
+    不在其中的卡返回 NOT_SUPPORTED。hang = (卡号, 第几次取利用率, 秒数) 模拟单卡 NVML 调用挂住。
+    calls 记录各函数调用次数。
+    """
+    SUCCESS, NOT_SUPPORTED, NOT_FOUND, INSUFFICIENT_SIZE = 0, 3, 6, 7
+
+    def __init__(self, gpus=2, procs=None, proc_util=None, hang=None):
+        self.gpus = gpus
+        self.procs = procs if procs is not None else {0: [(1000 + i, (i + 1) << 20) for i in range(20)]}
+        self.proc_util = proc_util or {}
+        self.hang = hang
+        self.calls = {}
+        self.util_calls = {}
+        self.energy = {}  # 卡号 -> 累计 mJ
+        self.clock_us = 1_000_000
+
+    def _n(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    @staticmethod
+    def _gpu(h):
+        return h.value & 0xff
+
+    def nvmlInit(self): self._n("init"); return self.SUCCESS
+    def nvmlShutdown(self): self._n("shutdown"); return self.SUCCESS
+
+    def nvmlDeviceGetCount_v2(self, c):
+        c._obj.value = self.gpus
+        return self.SUCCESS
+
+    def nvmlDeviceGetHandleByIndex_v2(self, i, h):
+        self._n("handle")
+        h._obj.value = 0x100 + i
+        return self.SUCCESS
+
+    def nvmlDeviceGetPciInfo_v3(self, h, pci):
+        self._n("pci")
+        pci._obj.busId = b"00000000:%02X:00.0" % (0x10 + self._gpu(h))
+        return self.SUCCESS
+
+    def nvmlDeviceGetName(self, h, buf, n):
+        buf.value = b"FakeGPU"
+        return self.SUCCESS
+
+    def nvmlDeviceGetUtilizationRates(self, h, u):
+        g = self._gpu(h)
+        self.util_calls[g] = self.util_calls.get(g, 0) + 1
+        if self.hang and self.hang[0] == g and self.hang[1] == self.util_calls[g]:
+            time.sleep(self.hang[2])
+        u._obj.gpu = 40 + g
+        return self.SUCCESS
+
+    def nvmlDeviceGetPowerUsage(self, h, p):
+        p._obj.value = 250000
+        return self.SUCCESS
+
+    def nvmlDeviceGetMemoryInfo(self, h, m):
+        m._obj.total = 80 << 30
+        m._obj.used = 10 << 30
+        return self.SUCCESS
+
+    def nvmlDeviceGetTotalEnergyConsumption(self, h, e):
+        # 每次读取前进 250 J (250 W x 1 s)
+        g = self._gpu(h)
+        self.energy[g] = self.energy.get(g, 0) + 250000
+        e._obj.value = self.energy[g]
+        return self.SUCCESS
+
+    def nvmlDeviceGetClockInfo(self, h, typ, v):
+        v._obj.value = 1410 if typ == 1 else 1215
+        return self.SUCCESS
+
+    def nvmlDeviceGetTemperature(self, h, typ, v):
+        v._obj.value = 65
+        return self.SUCCESS
+
+    def nvmlDeviceGetCurrentClocksThrottleReasons(self, h, v):
+        v._obj.value = 0x4
+        return self.SUCCESS
+
+    def nvmlDeviceGetFieldValues(self, h, n, arr):
+        self._n("fields")
+        self.clock_us += 500_000
+        for i in range(n):
+            fv = arr[i]
+            fv.timestamp = self.clock_us
+            if fv.fieldId == 82:
+                fv.valueType, fv.value.uiVal, fv.nvmlReturn = 1, 70, self.SUCCESS
+            elif fv.fieldId in (197, 198):
+                # 与真实 NVML 一致: 197 = PCIE_COUNT_TX_BYTES, 198 = PCIE_COUNT_RX_BYTES (RX 速率取 TX 的 2 倍以便区分)
+                per_step = (100 << 20) * (2 if fv.fieldId == 198 else 1)
+                fv.valueType, fv.value.ullVal, fv.nvmlReturn = 3, (self.clock_us // 500_000) * per_step, self.SUCCESS
+            else:
+                fv.nvmlReturn = self.NOT_SUPPORTED
+        return self.SUCCESS
+
+    def nvmlDeviceGetComputeRunningProcesses(self, h, cnt, arr):
+        self._n("procs")
+        ps = self.procs.get(self._gpu(h), [])
+        if cnt._obj.value < len(ps):
+            cnt._obj.value = len(ps)
+            return self.INSUFFICIENT_SIZE
+        for i, (pid, mem) in enumerate(ps):
+            arr[i].pid = pid
+            arr[i].usedGpuMemory = mem
+        cnt._obj.value = len(ps)
+        return self.SUCCESS
+
+    def nvmlDeviceGetProcessUtilization(self, h, arr, cnt, last_seen):
+        samples = self.proc_util.get(self._gpu(h))
+        if samples is None: return self.NOT_SUPPORTED
+        ts = last_seen + 100
+        for i, (pid, sm) in enumerate(samples):
+            arr[i].pid = pid
+            arr[i].timeStamp = ts
+            arr[i].smUtil = sm
+        cnt._obj.value = len(samples)
+        return self.SUCCESS
+
+class _Writer:
+    def __init__(self):
+        self.rows = []  # (pid, filename, val)
+
+    def write(self, pid, filename, ts, val, header=None):
+        self.rows.append((pid, filename, val))
+
+    def of(self, filename):
+        return [(pid, val) for pid, f, val in self.rows if f == filename]
+
+class _Stats:
+    def lap(self, stage): pass
+
+class _Tracker:
+    """固定 PID 集合的 ProcessTracker 替身 (替身进程在 /proc 中并不存在)"""
+    def __init__(self, target_name, pids):
+        self.matcher = PidMatcher(target_name)
+        self.pids = list(pids)
+
+    def get_pids(self):
+        return self.pids
+
+def _run(collector, ticks, pids=(), interval=0.0):
+    writer = _Writer()
+    ctx = TickContext(writer, _Stats(), _Tracker("fake_solver", pids))
+    for i in range(ticks):
+        ctx.begin(i)
+        collector.collect(ctx)
+        if interval: time.sleep(interval)
+    collector.close()
+    return writer
+
+def main():
+    failed = []
+    def check(ok, msg):
+        print(f"{'✅' if ok else '❌'} {msg}")
+        if not ok: failed.append(msg)
+
+    ticks = 5
+    lib = FakeNvmlLib()
+    mgr = NativeNvmlManager(lib)
+    for _ in range(ticks): mgr.sample()
+    check(lib.calls.get("handle") == 2 and lib.calls.get("pci") == 2, f"句柄/PCI 只解析一次: {lib.calls}")
+    check(lib.calls.get("procs") == ticks * 2 + 1, f"进程缓冲扩容一次后复用: procs 调用 {lib.calls.get('procs')} 次")
+
+    lib = FakeNvmlLib(procs={0: [(1000, 1 << 30), (1001, 1 << 30)], 1: [(1002, 1 << 30)]},
+                      proc_util={0: [(1000, 70), (1001, 20)]})
+    w = _run(GpuCollector("fake_solver", nvml_lib=lib, detail=True), ticks, pids=(1000, 1001, 1002))
+    devices = w.of("gpu_devices.csv")
+    check(len(devices) == ticks * 2, f"gpu_devices.csv 每 tick 每卡一行: {len(devices)} 行")
+    check(devices[-1][1].split(',')[-1] == f"{ticks * 250:.3f}", f"累计能耗换算为焦耳: {devices[-1][1]}")
+    utils = {pid: val.split(',')[1] for pid, val in w.of("gpu0.csv")}
+    check(utils == {1000: "70.0", 1001: "20.0"}, f"共享卡按进程级 SM 利用率: {utils}")
+    # detail 列: SmClock,DramClock,Temp,DramTemp,ThrottleReasons,PcieRx,PcieTx,...
+    pcie = w.of("gpu0.csv")[-1][1].split(',')[8:10]
+    check(all(pcie) and float(pcie[0]) == 2 * float(pcie[1]), f"PCIe RX/TX 字段 ID 正确: rx,tx = {pcie}")
+    gpu1 = w.of("gpu1.csv")
+    check(bool(gpu1) and gpu1[0][1].split(',')[1] == "41", f"不支持进程级采样的卡回退为设备利用率: {gpu1[:1]}")
+
+    lib = FakeNvmlLib(procs={0: [(1000, 1 << 30)], 1: [(1001, 1 << 30)]}, hang=(1, 3, 1.0))
+    w = _run(GpuCollector("fake_solver", nvml_lib=lib, nvml_timeout=0.2), 8, pids=(1000, 1001), interval=0.2)
+    events = [val.split(',')[2] for _, val in w.of("nvml_events.csv")]
+    check(events[:2] == ["timeout", "returned"], f"挂住的卡记为 timeout / returned: {events}")
+    check(len(w.of("gpu0.csv")) == 8, f"健康卡每 tick 照常采样: {len(w.of('gpu0.csv'))} 行")
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
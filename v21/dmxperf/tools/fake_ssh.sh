@@ -0,0 +1,31 @@
+#!/bin/bash
+# dmxperf/tools/fake_ssh.sh
+# 本地 ssh 替身 (DMX_SSH 指向本脚本): 所有"节点"都在本机执行，模拟 ControlMaster 行为，
+# 把连接事件逐行记到 $FAKE_SSH_LOG:
+#   connect <node>  无可用主连接 (未开启复用或控制 socket 不存在)，指定了 ControlPath 时创建之
+#   reuse <node>    控制 socket 已存在，复用主连接
+#   exit <node>     ssh -O exit 关闭主连接 (删除控制 socket)
+# ControlPath 中的 %C 以节点名代替 (真实 ssh 为连接参数的哈希)，ControlPersist 不模拟。
+# 用法见 dmxperf/tools/ssh_mux_check.py。
+log="${FAKE_SSH_LOG:-/dev/null}"
+cp=""; op=""; args=()
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -o) case "$2" in ControlPath=*) cp="${2#ControlPath=}";; esac; shift 2;;
+    -O) op="$2"; shift 2;;
+    *) args+=("$1"); shift;;
+  esac
+done
+node="${args[0]}"; sock="${cp//%C/$node}"
+if [ "$op" = exit ]; then
+  echo "exit $node" >> "$log"
+  [ -e "$sock" ] || exit 255
+  rm -f "$sock"; exit 0
+fi
+if [ -n "$cp" ] && [ -e "$sock" ]; then
+  echo "reuse $node" >> "$log"
+else
+  echo "connect $node" >> "$log"
+  [ -n "$cp" ] && touch "$sock"
+fi
+exec bash -c "${args[*]:1}"
@@ -0,0 +1,66 @@
+# dmxperf/tools/ssh_mux_check.py
+# -*- coding: utf-8 -*-
+"""
+ssh 连接复用自检: 用本地替身 fake_ssh.sh 代替 ssh，验证 SSHExecutor 每节点只建一次主连接。
+
+对 N 个虚拟节点连续下发若干轮命令 (run_on_nodes)，再调用 close_multiplexing()，
+检查替身记录的事件: 每个节点恰好 1 次 connect、(轮数 - 1) 次 reuse、1 次 exit，
+且 ssh 选项带有有限的 ControlPersist。
+
+用法:
+    python3 -m dmxperf.tools.ssh_mux_check --nodes 8 --rounds 3
+"""
+import argparse
+import collections
+import os
+import shutil
+import sys
+import tempfile
+
+FAKE_SSH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ssh.sh")
+
+def main():
+    parser = argparse.ArgumentParser(description="用本地 ssh 替身验证 ControlMaster 连接复用")
+    parser.add_argument("--nodes", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--persist", default="10m", help="ControlPersist 取值")
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix="dmx_muxcheck_")
+    log = os.path.join(work, "ssh.log")
+    # SSHExecutor / relay 在导入时读取 DMX_SSH
+    os.environ["DMX_SSH"] = FAKE_SSH
+    os.environ["FAKE_SSH_LOG"] = log
+    from dmxperf.infra.executor import SSHExecutor, run_on_nodes
+
+    nodes = [f"muxcheck-node{i:03d}" for i in range(args.nodes)]
+    failed = []
+    try:
+        SSHExecutor.enable_multiplexing(args.persist)
+        prefix = SSHExecutor.ssh_prefix(nodes[0])
+        if f"ControlPersist={args.persist}" not in prefix:
+            failed.append(f"ssh 选项缺少 ControlPersist={args.persist}: {prefix}")
+        for i in range(args.rounds):
+            results = run_on_nodes([(n, f"true round{i}") for n in nodes])
+            failed += [f"第 {i} 轮 {r}" for r in results if r.code != 0]
+        SSHExecutor.close_multiplexing()
+
+        events = collections.Counter()
+        with open(log, encoding='utf-8') as f:
+            for line in f:
+                events[tuple(line.split())] += 1
+        for n in nodes:
+            got = (events[("connect", n)], events[("reuse", n)], events[("exit", n)])
+            if got != (1, args.rounds - 1, 1):
+                failed.append(f"{n}: connect/reuse/exit = {got}, 期望 (1, {args.rounds - 1}, 1)")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    for msg in failed:
+        print(f"❌ {msg}")
+    if not failed:
+        print(f"✅ {len(nodes)} 个节点 x {args.rounds} 轮: 每节点 1 次建连, {args.rounds - 1} 次复用, 1 次关闭")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,7 @@ import os
 import shutil
 import socket
 from .base import BaseWorkload, WorkloadContext
+from dmxperf.infra.executor import SSHExecutor
 
 class DmxCommonWorkload(BaseWorkload):
     """
@@ -114,7 +115,7 @@ class DmxCommonWorkload(BaseWorkload):
             else:
                 try:
                     # 使用 SSH 远程创建 (mkdir -p 保证如果已存在不会报错，父目录不存在会自动创建)
-                    cmd = f"ssh {node} 'mkdir -p {path}'"
+                    cmd = f"{SSHExecutor.ssh_prefix(node)} 'mkdir -p {path}'"
                     ret = os.system(cmd)
                     if ret != 0:
                         print(f"⚠️  节点 {node} 目录创建可能失败 (Exit Code: {ret})")
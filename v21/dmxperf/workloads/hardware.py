@@ -4,6 +4,7 @@ import os
 import sys
 import socket
 from .base import BaseWorkload, WorkloadContext
+from dmxperf.infra.executor import SSHExecutor, is_local_node, tree_dispatch_cmd
 
 class HardwareWorkload(BaseWorkload):
     """
@@ -69,7 +70,27 @@ class HardwareWorkload(BaseWorkload):
         # 最终命令: ./dmxperf --gemm 16384 10
         final_tool_cmd = f"{base_cmd} {cli_flag} {tool_args}"
 
-        # 5. 构建并行 SSH 命令组 (保持不变)
+        # 5. 构建并行 SSH 命令组
+        #    远程节点数超过 tree_threshold 时改为经中继树分发: 日志由各节点直接写入共享目录，
+        #    本机只连接 tree_fanout 个中继，逐节点返回码汇总到 <case>_dispatch_status.jsonl
+        tree_threshold = int(self.global_cfg.get('tree_threshold', 512))
+        remote_nodes = [n for n in target_nodes if not is_local_node(n)]
+        if tree_threshold and len(remote_nodes) > tree_threshold:
+            node_cmds = []
+            for node in target_nodes:
+                node_log = os.path.join(log_dir, f"{node}.log")
+                if is_local_node(node):
+                    node_cmds.append((node, f"{final_tool_cmd} > {node_log} 2>&1"))
+                else:
+                    node_cmds.append((node, f"bash -l -c '{final_tool_cmd}' > {node_log} 2>&1"))
+            status_log = os.path.join(log_dir, f"{ctx.case_name}_dispatch_status.jsonl")
+            ctx.cmd_string = (tree_dispatch_cmd(node_cmds, int(self.global_cfg.get('tree_fanout', 32)),
+                                                max_workers=int(self.global_cfg.get('fanout_workers', 64)))
+                              + f" > {status_log}")
+            ctx.log_file = os.path.join(self.run_root, "logs", f"{ctx.case_name}_dispatch.log")
+            ctx.env = os.environ.copy()
+            return ctx
+
         ssh_cmds = []
         local_hostname = socket.gethostname()
         
@@ -81,7 +102,7 @@ class HardwareWorkload(BaseWorkload):
             else:
                 # 使用 bash -l -c 确保加载环境变量
                 remote_cmd = f"bash -l -c '{final_tool_cmd}'"
-                cmd = f"ssh -o StrictHostKeyChecking=no {node} \"{remote_cmd}\" > {node_log} 2>&1"
+                cmd = f"{SSHExecutor.ssh_prefix(node)} \"{remote_cmd}\" > {node_log} 2>&1"
             
             ssh_cmds.append(cmd)
 